@@ -0,0 +1,217 @@
+import itertools
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import ray
+import torch
+import torch.multiprocessing as mp
+
+
+'''
+Execution backends for runner actors.
+
+'ray' uses Ray actors and the object store. 'local' runs each actor in its own
+process on this machine; arguments and results travel through queues with
+tensors and numpy arrays placed in shared memory, so weights and experience
+are not copied through pipes. Both expose the Ray calling convention:
+actor.method.remote(*args) returns a reference that get and wait accept.
+'''
+
+backend_name = None
+local_backend = None
+
+
+def init(name='ray'):
+    global backend_name, local_backend
+    assert name in ('ray', 'local')
+    backend_name = name
+    if name == 'ray':
+        if not ray.is_initialized():
+            ray.init()
+    else:
+        local_backend = LocalBackend()
+
+
+def create_actor(cls, *args, max_concurrency=1, env_vars=None, **ray_options):
+    # env_vars are set before the actor process imports anything,
+    # ray_options (num_cpus, num_gpus, ...) only apply to the ray backend
+    if backend_name == 'ray':
+        if env_vars:
+            ray_options['runtime_env'] = {'env_vars': env_vars}
+        return ray.remote(**ray_options)(cls).options(max_concurrency=max_concurrency).remote(*args)
+    return LocalActor(local_backend, cls, args, max_concurrency, env_vars)
+
+
+def put(obj):
+    if backend_name == 'ray':
+        return ray.put(obj)
+    # tensors are moved to shared memory once, every later send only passes a handle
+    for tensor in iter_tensors(obj):
+        tensor.share_memory_()
+    return obj
+
+
+def get(ref):
+    # values that are not references (e.g. weights sent by the local backend) are returned as is
+    if isinstance(ref, list):
+        return [get(r) for r in ref]
+    if isinstance(ref, ray.ObjectRef):
+        return ray.get(ref)
+    if isinstance(ref, LocalRef):
+        return ref.result()
+    return ref
+
+
+def wait(refs, timeout=None):
+    if refs and isinstance(refs[0], LocalRef):
+        return local_backend.wait(refs, timeout)
+    return ray.wait(refs, timeout=timeout)
+
+
+def kill(actor):
+    if isinstance(actor, LocalActor):
+        actor.kill()
+    else:
+        ray.kill(actor)
+
+
+def iter_tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from iter_tensors(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            yield from iter_tensors(value)
+
+
+class SharedArray(object):
+    # numpy array sent as a tensor so torch.multiprocessing passes it through shared memory
+    def __init__(self, array):
+        self.tensor = torch.from_numpy(np.ascontiguousarray(array))
+
+
+def share(obj):
+    if isinstance(obj, np.ndarray):
+        return SharedArray(obj)
+    if isinstance(obj, dict):
+        return {key: share(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(share(value) for value in obj)
+    return obj
+
+
+def unshare(obj):
+    if isinstance(obj, SharedArray):
+        return obj.tensor.numpy()
+    if isinstance(obj, dict):
+        return {key: unshare(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(unshare(value) for value in obj)
+    return obj
+
+
+class LocalRef(object):
+    def __init__(self, call_id):
+        self.call_id = call_id
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.value
+
+
+class LocalBackend(object):
+    def __init__(self):
+        self.context = mp.get_context('spawn')
+        self.results = self.context.Queue() # (call id, error, result) from every actor
+        self.refs = {} # call id -> LocalRef still running
+        self.call_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        self.actors = []
+
+        self.receiver = threading.Thread(target=self.receive, daemon=True)
+        self.receiver.start()
+
+    def submit(self, actor, method, args):
+        with self.lock:
+            ref = LocalRef(next(self.call_ids))
+            self.refs[ref.call_id] = ref
+        actor.commands.put((ref.call_id, method, share(args)))
+        return ref
+
+    def receive(self):
+        while True:
+            call_id, error, value = self.results.get()
+            with self.lock:
+                ref = self.refs.pop(call_id)
+                ref.value = unshare(value)
+                ref.error = error
+                ref.done.set()
+                self.finished.notify_all()
+
+    def wait(self, refs, timeout=None):
+        # same contract as ray.wait with num_returns=1
+        with self.finished:
+            self.finished.wait_for(lambda: any(ref.done.is_set() for ref in refs), timeout)
+            done = [ref for ref in refs if ref.done.is_set()][:1]
+        pending = [ref for ref in refs if ref not in done]
+        return done, pending
+
+
+class LocalMethod(object):
+    def __init__(self, actor, method):
+        self.actor = actor
+        self.method = method
+
+    def remote(self, *args):
+        return self.actor.backend.submit(self.actor, self.method, args)
+
+
+class LocalActor(object):
+    def __init__(self, backend, cls, args, max_concurrency=1, env_vars=None):
+        self.backend = backend
+        self.commands = backend.context.Queue()
+        self.process = backend.context.Process(target=run_actor, daemon=True,
+                                               args=(cls, share(args), max_concurrency, self.commands, backend.results))
+
+        # spawned processes copy the environment when they start
+        saved_env = dict(os.environ)
+        os.environ.update(env_vars or {})
+        try:
+            self.process.start()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_env)
+        backend.actors.append(self)
+
+    def __getattr__(self, method):
+        return LocalMethod(self, method)
+
+    def kill(self):
+        self.process.terminate()
+
+
+def run_actor(cls, args, max_concurrency, commands, results):
+    # entry point of a local actor process, runs calls on up to max_concurrency threads
+    instance = cls(*unshare(args))
+    pool = ThreadPoolExecutor(max_concurrency)
+
+    def run_call(call_id, method, args):
+        try:
+            results.put((call_id, None, share(getattr(instance, method)(*unshare(args)))))
+        except Exception:
+            results.put((call_id, traceback.format_exc(), None))
+
+    while True:
+        call_id, method, args = commands.get()
+        pool.submit(run_call, call_id, method, args)
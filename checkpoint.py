@@ -0,0 +1,109 @@
+import glob
+import os
+import queue
+import threading
+
+import torch
+
+from parameter import *
+
+
+'''
+Checkpoints are written as checkpoint_<episode>.pth in the model directory,
+through a temporary file and an atomic rename, so a crash mid-write never
+damages an earlier checkpoint. The newest KEEP_CHECKPOINTS files are kept and
+the file named 'latest' holds the name of the newest one.
+'''
+
+LATEST = 'latest'
+
+
+def cpu_copy(obj):
+    # copy of a (nested) state dict with every tensor cloned to CPU memory
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return {key: cpu_copy(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(value) for value in obj)
+    return obj
+
+
+def atomic_write(path, write):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def checkpoint_files(directory):
+    # newest first
+    return sorted(glob.glob(os.path.join(directory, 'checkpoint_*.pth')), reverse=True)
+
+
+class CheckpointWriter:
+    # Snapshots state into CPU memory on the caller's thread and writes it on a background thread
+    def __init__(self, directory, keep=KEEP_CHECKPOINTS):
+        self.directory = directory
+        self.keep = keep
+        self.pending = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, checkpoint):
+        # only the copy into CPU memory blocks the training thread
+        if self.error is not None:
+            raise self.error
+        self.pending.put(cpu_copy(checkpoint))
+
+    def run(self):
+        while True:
+            checkpoint = self.pending.get()
+            if checkpoint is None:
+                break
+            try:
+                self.write(checkpoint)
+            except Exception as e:
+                self.error = e
+
+    def write(self, checkpoint):
+        name = 'checkpoint_{:09d}.pth'.format(checkpoint['episode'])
+        atomic_write(os.path.join(self.directory, name), lambda f: torch.save(checkpoint, f))
+        atomic_write(os.path.join(self.directory, LATEST), lambda f: f.write(name.encode()))
+        for path in checkpoint_files(self.directory)[self.keep:]:
+            os.remove(path)
+        print('Saved model', name)
+
+    def close(self):
+        # waits for the checkpoints already queued
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def load_latest_checkpoint(directory, map_location=None):
+    # newest checkpoint that loads, trying the 'latest' pointer, then every rotated file, then a legacy checkpoint.pth
+    candidates = []
+    latest = os.path.join(directory, LATEST)
+    if os.path.exists(latest):
+        with open(latest) as f:
+            candidates.append(os.path.join(directory, f.read().strip()))
+    candidates += checkpoint_files(directory)
+    candidates.append(os.path.join(directory, 'checkpoint.pth'))
+
+    for path in dict.fromkeys(candidates):
+        if not os.path.exists(path):
+            continue
+        try:
+            checkpoint = torch.load(path, map_location=map_location)
+        except Exception as e:
+            print('Skipping unreadable checkpoint {}: {}'.format(path, str(e).splitlines()[0]))
+            continue
+        if all(key in checkpoint for key in ('policy_model', 'policy_optimizer', 'episode')):
+            return path, checkpoint
+        print('Skipping incomplete checkpoint {}'.format(path))
+    raise FileNotFoundError('no valid checkpoint in {}'.format(directory))
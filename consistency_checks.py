@@ -0,0 +1,163 @@
+import argparse
+import copy
+import os
+import tempfile
+
+import torch
+from torch.optim import Adam
+
+from learner import DataParallelLearner, PPOLearner
+from network import RL_Policy
+from observation import compress_observations, expand_observations, storage_dtype, storage_shape
+from replay_buffer import ReplayBuffer
+from parameter import *
+
+
+'''
+Checks that the optimised code paths reproduce their reference behaviour on
+fixed, seeded inputs. Every check prints its largest error and the script exits
+with status 1 when one exceeds its tolerance:
+
+    python consistency_checks.py
+    python consistency_checks.py data_parallel --processes 4
+'''
+
+
+def random_rollouts(actor_critic, batch_size, seed):
+    # a minibatch in the replay storage layout with log probs of the current policy
+    generator = torch.Generator().manual_seed(seed)
+    observations = (torch.rand((batch_size, *OBS_DIM), generator=generator) > 0.5).float()
+    actions = torch.randn((batch_size, 2), generator=generator)
+    with torch.no_grad():
+        _, log_probs, _ = actor_critic.evaluate_actions(observations, actions)
+    rewards = torch.randn(batch_size, generator=generator)
+    returns = torch.randn(batch_size, generator=generator)
+    return [compress_observations(observations), actions, log_probs.reshape(-1), rewards, returns]
+
+
+def check_observation_storage(args):
+    # binary observations survive compression to every storage layout unchanged
+    generator = torch.Generator().manual_seed(args.seed)
+    observations = (torch.rand((args.batch_size, *OBS_DIM), generator=generator) > 0.5).float()
+    error = 0.
+    for storage in ('float', 'uint8', 'bitpack'):
+        stored = compress_observations(observations, storage)
+        if stored.shape[1:] != storage_shape(OBS_DIM, storage) or stored.dtype != storage_dtype(storage):
+            return float('inf'), '{} stores {} {} observations'.format(storage, stored.dtype, tuple(stored.shape[1:]))
+        error = max(error, (expand_observations(stored, storage) - observations).abs().max().item())
+    return error, 'round trip differs by {:.1f} over float, uint8 and bitpack'.format(error)
+
+
+def ring_rows(replay_buffer):
+    # rows of every field from the oldest to the newest
+    order = (replay_buffer.next_index - len(replay_buffer) + torch.arange(len(replay_buffer))) % replay_buffer.capacity
+    return [buffer.index_select(0, order) for buffer in replay_buffer.buffers()]
+
+
+def add_random_episodes(replay_buffer, reference, generator, num_episodes, max_length):
+    # episodes with row ids in every field, reference collects the same rows in a list
+    for _ in range(num_episodes):
+        length = int(torch.randint(1, max_length + 1, (1,), generator=generator))
+        ids = torch.arange(len(reference), len(reference) + length)
+        observations = (ids % 256).to(torch.uint8).reshape(-1, 1, 1, 1).expand(length, *replay_buffer.observations.shape[1:])
+        episode = [observations, torch.stack([ids, -ids], 1).float(), ids.float(), 2 * ids.float(), 3 * ids.float()]
+        replay_buffer.add_episode(*[data.numpy() for data in episode])
+        reference += [[data[i] for data in episode] for i in range(length)]
+
+
+def ring_error(replay_buffer, reference):
+    expected = reference[-replay_buffer.capacity:]
+    if len(replay_buffer) != len(expected):
+        return float('inf')
+    rows = ring_rows(replay_buffer)
+    return max((field.float() - torch.stack([row[i] for row in expected]).float()).abs().max().item()
+               for i, field in enumerate(rows))
+
+
+def check_replay_ring(args):
+    # episodes of random lengths, some longer than the buffer, and in-place shrinks of the
+    # buffer in RAM and on disk, against a list of the newest rows
+    generator = torch.Generator().manual_seed(args.seed)
+    error = 0.
+    num_rows = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for location in ('memory', 'disk'):
+            replay_buffer = ReplayBuffer(97, (2, 4, 8), 2, storage='uint8', location=location,
+                                         path=os.path.join(directory, 'replay.obs'))
+            reference = []
+            for i in range(20):
+                add_random_episodes(replay_buffer, reference, generator, 3, 50)
+                error = max(error, ring_error(replay_buffer, reference))
+                if i % 4 == 3:
+                    replay_buffer.resize(replay_buffer.capacity - int(torch.randint(1, 20, (1,), generator=generator)))
+                    error = max(error, ring_error(replay_buffer, reference))
+            num_rows += len(reference)
+            replay_buffer.close()
+    return error, 'rows differ by {:.1f} after {} rows through rings shrunk from 97 to {}'.format(
+        error, num_rows, replay_buffer.capacity)
+
+
+def check_data_parallel(args):
+    # one update of the gloo data-parallel learner against the same update in this process,
+    # the error is relative to how far the update moved the parameters
+    torch.manual_seed(args.seed)
+    actor_critic = RL_Policy(INPUT_DIM, 2, downscaling=OBS_DOWNSCALING)
+    reference = copy.deepcopy(actor_critic)
+    initial = copy.deepcopy(actor_critic)
+    stored_rollouts = random_rollouts(reference, args.batch_size, args.seed)
+
+    reference_optimizer = Adam(reference.parameters(), lr=args.lr, eps=1e-5)
+    rollouts = [expand_observations(stored_rollouts[0])] + stored_rollouts[1:]
+    reference_losses = PPOLearner(reference, reference_optimizer).update(rollouts)
+
+    learner = DataParallelLearner(actor_critic, Adam(actor_critic.parameters(), lr=args.lr, eps=1e-5),
+                                  num_processes=args.processes, port=args.port)
+    try:
+        losses = learner.update(stored_rollouts)
+    finally:
+        learner.stop()
+
+    error = max((param - reference_param).abs().max().item()
+                for param, reference_param in zip(actor_critic.parameters(), reference.parameters()))
+    moved = max((param - initial_param).abs().max().item()
+                for param, initial_param in zip(reference.parameters(), initial.parameters()))
+    loss_error = max(abs(a - b) for a, b in zip(losses, reference_losses))
+    # Adam scales every step to about lr, so rounding in near-zero gradients shows up relative to the step
+    return error / moved, 'parameters differ by {:.2e} after moving up to {:.2e}, losses by {:.2e}, {} processes'.format(
+        error, moved, loss_error, args.processes)
+
+
+CHECKS = {
+    'observation_storage': (check_observation_storage, 0.),
+    'replay_ring': (check_replay_ring, 0.),
+    'data_parallel': (check_data_parallel, 1e-2),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='check optimised code paths against their reference behaviour')
+    parser.add_argument('checks', nargs='*', default=list(CHECKS), help='any of {}, all by default'.format(', '.join(CHECKS)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=32, help='observations per check')
+    parser.add_argument('--lr', type=float, default=LR, help='learning rate of the data-parallel check')
+    parser.add_argument('--processes', type=int, default=2, help='learner processes of the data-parallel check')
+    parser.add_argument('--port', type=int, default=LEARNER_PORT)
+    args = parser.parse_args()
+
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error('unknown checks {}'.format(', '.join(unknown)))
+
+    failed = 0
+    for name in args.checks:
+        check, tolerance = CHECKS[name]
+        error, message = check(args)
+        status = 'OK' if error <= tolerance else 'FAIL'
+        failed += status == 'FAIL'
+        print('{:<4} {}: {}'.format(status, name, message))
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
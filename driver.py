@@ -1,28 +1,26 @@
 import torch
-from torch import nn
 from torch.optim import Adam
 from torch.utils.tensorboard import SummaryWriter
 
 import numpy as np
-import ray
 
 import os
 
-import random
-
 
+import backend
+from checkpoint import CheckpointWriter, load_latest_checkpoint
 from network import RL_Policy
-from runner import RLRunner
+from inference_server import RLInferenceServer
+from learner import DataParallelLearner, PPOLearner
+from memory import MemoryMonitor, write_memory_usage
+from prefetcher import BatchPrefetcher, EpisodeIngestor, JobCollector
+from replay_buffer import ReplayBuffer
+from resources import configure_threads, thread_env_vars
+from runner import Runner
+from timing import format_stage_timings, stage, stage_timers, write_stage_timings
+from weights import WeightPublisher
 from parameter import *
 
-ray.init()
-print("Welcome to RL autonomous exploration!")
-
-writer = SummaryWriter(train_path)
-if not os.path.exists(model_path):
-    os.makedirs(model_path)
-if not os.path.exists(gifs_path):
-    os.makedirs(gifs_path)
 
 def writeToTensorBoard(writer, tensorboardData, curr_episode):
     # each row in tensorboardData represents an episode
@@ -42,12 +40,22 @@ def writeToTensorBoard(writer, tensorboardData, curr_episode):
     writer.add_scalar(tag='Perf/Success Rate', scalar_value=success_rate, global_step=curr_episode)
 
 def main():
+    # start the execution backend here rather than at import, local actor processes import this module
+    backend.init(EXECUTION_BACKEND)
+    print("Welcome to RL autonomous exploration!")
+    configure_threads('learner')
+
+    writer = SummaryWriter(train_path)
+    if not os.path.exists(model_path):
+        os.makedirs(model_path)
+    if not os.path.exists(gifs_path):
+        os.makedirs(gifs_path)
+
     # Handle devices for global training and local simulation
     device = torch.device('cuda') if USE_GPU_GLOBAL else torch.device('cpu')
-    local_device = torch.device('cuda') if USE_GPU else torch.device('cpu')
 
     # initialize actor critic network
-    actor_critic = RL_Policy(INPUT_DIM, 2).to(device)
+    actor_critic = RL_Policy(INPUT_DIM, 2, downscaling=OBS_DOWNSCALING).to(device)
 
     # Initialize optimizer
     actor_critic_optim = Adam(actor_critic.parameters(), lr=LR, eps=1e-5)
@@ -58,7 +66,8 @@ def main():
     # load model and optimizer trained before
     if LOAD_MODEL:
         print('Loading Model...')
-        checkpoint = torch.load(model_path + '/checkpoint.pth')
+        checkpoint_path, checkpoint = load_latest_checkpoint(model_path, map_location=device)
+        print("resuming from", checkpoint_path)
         actor_critic.load_state_dict(checkpoint['policy_model'])
         actor_critic_optim.load_state_dict(checkpoint['policy_optimizer'])
 
@@ -69,21 +78,33 @@ def main():
 
         print(f"Learning... Running {MAX_TIMESTEP_PER_EPISODE} timesteps per episode, ", end='')
 
-    # launch meta agents
-    meta_agents = [RLRunner.remote(i) for i in range(NUM_META_AGENT)]
-    
-    if device != local_device:
-        actor_critic_weights = actor_critic.to(local_device).state_dict()
-        actor_critic.to(device)
+    # PPO updates run in this process, or sharded over LEARNER_PROCESSES processes
+    if LEARNER_PROCESSES > 1:
+        assert not USE_GPU_GLOBAL, "the data-parallel learner runs on CPU"
+        learner = DataParallelLearner(actor_critic, actor_critic_optim)
     else:
-        actor_critic_weights = actor_critic.to(local_device).state_dict()
+        learner = PPOLearner(actor_critic, actor_critic_optim)
+
+    # checkpoints are written on a background thread
+    checkpoint_writer = CheckpointWriter(model_path)
+
+    # launch meta agents
+    inference_server = None
+    if USE_INFERENCE_SERVER:
+        assert EXECUTION_BACKEND == 'ray', "the inference server needs the ray backend"
+        # every environment queries this actor, so it serves one request per environment at a time
+        inference_server = RLInferenceServer.options(max_concurrency=NUM_META_AGENT * ENVS_PER_RUNNER + 1).remote()
+    meta_agents = [backend.create_actor(Runner, i, inference_server, max_concurrency=ENVS_PER_RUNNER,
+                                        env_vars=thread_env_vars('runner', i),
+                                        num_cpus=RUNNER_NUM_THREADS, num_gpus=NUM_GPU/NUM_META_AGENT)
+                   for i in range(NUM_META_AGENT)]
+
+    # each model version is put in the object store once, jobs only carry a small packet
+    weight_publisher = WeightPublisher()
+    actor_critic_weights = weight_publisher.publish(actor_critic.state_dict())
+    if inference_server is not None:
+        backend.get(inference_server.set_weights.remote(actor_critic_weights))
 
-    # launch the first job on each runner
-    job_list = []
-    for i, meta_agent in enumerate(meta_agents):
-        curr_episode += 1
-        job_list.append(meta_agent.job.remote(actor_critic_weights, curr_episode))
-    
     # initialize metric collector
     metric_name = ['travel_dist', 'success_rate', 'explored_rate']
     training_data = []
@@ -92,138 +113,136 @@ def main():
         perf_metrics[n] = []
 
     # initialize training replay buffer
-    experience_buffer = []
-    for i in range(5):
-        experience_buffer.append([])
+    experience_buffer = ReplayBuffer(REPLAY_SIZE, OBS_DIM, 2)
+    print("Replay buffer capacity: {} rows, {:.1f} MB in RAM, {:.1f} MB on disk".format(experience_buffer.capacity,
+        (experience_buffer.nbytes - experience_buffer.disk_nbytes) / 2**20, experience_buffer.disk_nbytes / 2**20))
+
+    # finished jobs are fetched into the replay buffer and minibatches are
+    # prepared on background threads, the training thread only runs updates
+    if ASYNC_LEARNER:
+        # the staleness filter starts with the first publish after warm-up
+        ingestor = EpisodeIngestor(experience_buffer, EXPERIENCE_QUEUE_SIZE, MAX_POLICY_LAG)
+    else:
+        ingestor = EpisodeIngestor(experience_buffer)
+    prefetcher = None
+    num_updates = 0
+    next_update_samples = MINIMUM_BUFFER_SIZE # fetched samples the next async update waits for
+
+    # launch the first job on each runner
+    collector = JobCollector(meta_agents, ingestor, actor_critic_weights, curr_episode)
+    curr_episode = collector.curr_episode
+    saved_episode = curr_episode
+    # trims the replay buffer or throttles dispatch when over MEMORY_BUDGET
+    memory_monitor = MemoryMonitor(experience_buffer, collector, ingestor)
+    if ASYNC_LEARNER:
+        # runners are re-dispatched from a background thread and never wait for the learner
+        collector.start()
 
     try:
         while True:
-            done_id, job_list = ray.wait(job_list)
-            done_jobs = ray.get(done_id)
-            
-            for job in done_jobs:
-                job_results, metrics, info = job
-                for i in range(len(experience_buffer)):
-                    experience_buffer[i] += job_results[i]
+            with stage('learner/wait'):
+                if ASYNC_LEARNER:
+                    collector.check()
+                    # updates are paced by the incoming data rather than retraining on the same replay
+                    ready = ingestor.wait_for_samples(next_update_samples, timeout=0.1)
+                else:
+                    # wait for the next finished episode before each update
+                    collector.collect()
+            curr_episode = collector.curr_episode
+            memory_monitor.check()
+
+            for metrics in ingestor.drain_metrics():
                 for n in metric_name:
                     perf_metrics[n].append(metrics[n])
-            
-            curr_episode += 1
-            job_list.append(meta_agents[info['id']].job.remote(actor_critic_weights, curr_episode))
 
-            if curr_episode % 1 == 0 and len(experience_buffer[0]) >= MINIMUM_BUFFER_SIZE:
+            if ASYNC_LEARNER:
+                train = ready
+            else:
+                train = curr_episode % 1 == 0 and len(experience_buffer) >= MINIMUM_BUFFER_SIZE
+            if train:
                 print("Training")
+                samples = ingestor.samples
 
-                # keep the replay buffer size
-                if len(experience_buffer[0]) >= REPLAY_SIZE:
-                    for i in range(len(experience_buffer)):
-                        experience_buffer[i] = experience_buffer[i][-REPLAY_SIZE:]
-                
-                indices = range(len(experience_buffer[0]))
-     
-                # randomly sample a batch data
-                sample_indices = random.sample(indices, BATCH_SIZE)
-                rollouts = []
-                for i in range(len(experience_buffer)):
-                    rollouts.append([experience_buffer[i][index] for index in sample_indices])
+                # randomly sample a batch data, the ring buffer keeps the replay size
+                if prefetcher is None:
+                    # the data-parallel learner shards the batch before expanding observations
+                    prefetcher = BatchPrefetcher(experience_buffer, BATCH_SIZE, device, expand=LEARNER_PROCESSES == 1)
+                with stage('learner/batch'):
+                    rollouts = prefetcher.get()
 
                 # Append episode data
-                batch_obs = torch.stack(rollouts[0]).to(device)
-                batch_acts = torch.stack(rollouts[1]).to(device)
-                batch_log_probs = torch.stack(rollouts[2]).to(device)
-                batch_rewards = torch.stack(rollouts[3]).to(device)
-                batch_returns = torch.stack(rollouts[4]).to(device)
-
-                # Calculate advantage
-                curr_values = actor_critic.get_value(batch_obs)
-                A_k = batch_returns - curr_values
-                A_k = (A_k - A_k.mean()) / (A_k.std() + 1e-10) #NOTE MIGHT NOT HAVE TO NORMALISE
+                batch_rewards, batch_returns = rollouts[3], rollouts[4]
 
                 # training for n times each step
-                for _ in range(N_UPDATES_PER_ITERATIONS):
-
-                    # Calculate V_phi and pi_theta(a_t | s_t)
-                    curr_values, curr_log_probs, dist_entropy = actor_critic.evaluate_actions(batch_obs, batch_acts)
-    
-                    # Calculate surrogate losses.
-                    ratios = torch.exp(curr_log_probs - batch_log_probs)
-                    surr1 = ratios * A_k
-                    surr2 = torch.clamp(ratios, 1 - CLIP, 1 + CLIP) * A_k
-
-                    # Calculate actor and critic losses.
-                    actor_loss = (-torch.min(surr1, surr2)).mean()
-                    critic_loss = nn.MSELoss()(curr_values, batch_returns)
-
-                    ''' Clipped Critic Loss'''
-                    # value_pred_clipped = V_old.detach() + (V - V_old.detach()).clamp(-CLIP, CLIP)
-                    # value_losses = (V - batch_returns).pow(2)
-                    # value_losses_clipped = (value_pred_clipped - batch_returns).pow(2)
-                    # critic_loss = torch.max(value_losses, value_losses_clipped).mean()
-
-                    actor_critic_loss = actor_loss\
-                        + critic_loss * CRITIC_LOSS_COEF\
-                        - dist_entropy * ENTROPY_COEF
-                    
-                    # print(f"actor l {actor_loss}")
-                    # print(f"critic l {critic_loss}, {critic_loss * CRITIC_LOSS_COEF}")
-                    # print(f"entropy l {dist_entropy}, {dist_entropy * ENTROPY_COEF}")
-                    # print(f"total l {actor_critic_loss}")
-
-                    # Calculate gradients and perform backward propagation for actor critic network
-                    actor_critic_optim.zero_grad()
-                    actor_critic_loss.backward()
-                    actor_critic_grad_norm = nn.utils.clip_grad_norm_(actor_critic.parameters(),
-                                            max_norm=MAX_GRAD_NORM, norm_type=2)
-                    actor_critic_optim.step()
-
-                    '''Check Gradients'''
-                    # total_norm = 0
-                    # for name, param in actor_critic.named_parameters():
-                    #     if param.grad is not None:
-                    #         print(f'Parameter: {name}, Gradient Norm: {param.grad.norm()}')
-                    #         param_norm = param.grad.norm()
-                    #         total_norm += param_norm.item() ** 2
-                    # total_norm = total_norm ** (1. / 2)
-                    # print(f"total norm {total_norm}")
+                with stage('learner/update'):
+                    actor_loss, critic_loss, dist_entropy, actor_critic_grad_norm = learner.update(rollouts)
+                num_updates += 1
+                # credit for updates does not pile up while the learner is slower than the runners
+                next_update_samples = max(next_update_samples, samples) + 1 / MAX_UPDATES_PER_SAMPLE
 
                 # data record to be written in tensorboard
                 perf_data = []
                 for n in metric_name:
                     perf_data.append(np.nanmean(perf_metrics[n]))
-                data = [batch_rewards.mean().item(), batch_returns.mean().item(), actor_loss.item(),
-                        critic_loss.mean().item(), dist_entropy.mean().item(), actor_critic_grad_norm.item(), *perf_data]
+                data = [batch_rewards.mean().item(), batch_returns.mean().item(), actor_loss,
+                        critic_loss, dist_entropy, actor_critic_grad_norm, *perf_data]
                 training_data.append(data)
 
+                # publish the updated model as a new version, every PUBLISH_INTERVAL updates when async
+                if not ASYNC_LEARNER or num_updates % PUBLISH_INTERVAL == 0:
+                    with stage('learner/publish'):
+                        actor_critic_weights = weight_publisher.publish(actor_critic.state_dict())
+                        ingestor.published(weight_publisher.version)
+                        collector.weights_packet = actor_critic_weights
+                        if inference_server is not None:
+                            inference_server.set_weights.remote(actor_critic_weights)
+
             # write record to tensorboard
             if len(training_data) >= SUMMARY_WINDOW:
                 writeToTensorBoard(writer, training_data, curr_episode)
+                if ASYNC_LEARNER:
+                    policy_lag, ingestor.policy_lag = ingestor.policy_lag, []
+                    writer.add_scalar(tag='Async/Accepted Episodes', scalar_value=ingestor.accepted, global_step=curr_episode)
+                    writer.add_scalar(tag='Async/Dropped Episodes', scalar_value=ingestor.dropped, global_step=curr_episode)
+                    writer.add_scalar(tag='Async/Policy Lag', scalar_value=np.mean(policy_lag) if policy_lag else 0, global_step=curr_episode)
+                write_memory_usage(writer, memory_monitor.usage(), curr_episode)
+                if STAGE_TIMING:
+                    # runner stages arrive with their jobs, learner stages are recorded here
+                    stage_timings = stage_timers.drain()
+                    write_stage_timings(writer, stage_timings, curr_episode)
+                    summary = format_stage_timings(stage_timings)
+                    writer.add_text('Timing/Summary', '    ' + summary.replace('\n', '\n    '), global_step=curr_episode)
+                    print(summary)
                 training_data = []
                 perf_metrics = {}
                 for n in metric_name:
                     perf_metrics[n] = []
-                    
-            if device != local_device:
-                actor_critic_weights = actor_critic.to(local_device).state_dict()
-                actor_critic.to(device)
-            else:
-                actor_critic_weights = actor_critic.to(local_device).state_dict()
-            
-            # save the model
-            if curr_episode % SAVE_FREQ == 0:
+
+            # save the model every SAVE_FREQ episodes
+            if curr_episode // SAVE_FREQ > saved_episode // SAVE_FREQ:
+                saved_episode = curr_episode
                 print('Saving model', end='\n')
                 checkpoint = {"policy_model": actor_critic.state_dict(),
                                 "policy_optimizer": actor_critic_optim.state_dict(),
                                 "episode": curr_episode,
                         }
-                path_checkpoint = "./" + model_path + "/checkpoint.pth"
-                torch.save(checkpoint, path_checkpoint)
-                print('Saved model', end='\n')
+                checkpoint_writer.save(checkpoint)
                     
 
     except KeyboardInterrupt:
         print("CTRL_C pressed. Killing remote workers")
+        collector.stop()
+        ingestor.stop()
+        if prefetcher is not None:
+            prefetcher.stop()
+        if LEARNER_PROCESSES > 1:
+            learner.stop()
+        checkpoint_writer.close()
+        experience_buffer.close()
         for a in meta_agents:
-            ray.kill(a)
+            backend.kill(a)
+        if inference_server is not None:
+            backend.kill(inference_server)
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
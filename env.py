@@ -1,19 +1,27 @@
 from skimage import io
 import matplotlib.pyplot as plt
 import os
+import threading
 from skimage.measure import block_reduce
 import copy
 
 from sensor import *
 from graph_generator import *
 from node import *
+from rendering import belief_image, draw_cross, draw_disk, draw_points, draw_progress, line_points
+from timing import stage, timed
 from parameter import *
 
+# pyplot keeps global figure state, environments sharing a runner plot one at a time
+plot_lock = threading.Lock()
+
 class Env():
-    def __init__(self, map_index, k_size=20, plot=False, test=False):
+    def __init__(self, map_index, k_size=20, plot=False, test=False, map_dir=None):
         # import environment ground truth from dungeon files
         self.test = test
-        if self.test:
+        if map_dir is not None:
+            self.map_dir = map_dir
+        elif self.test:
             self.map_dir = f'DungeonMaps/easy'  # change to 'complex', 'medium', and 'easy'
         else:
             self.map_dir = f'DungeonMaps/train'
@@ -61,8 +69,9 @@ class Env():
                                                      self.ground_truth)\
 
         # downsampled belief has lower resolution than robot belief
-        self.downsampled_belief = block_reduce(self.robot_belief.copy(), block_size=(self.resolution, self.resolution),
-                                               func=np.min)
+        with stage('block_reduce'):
+            self.downsampled_belief = block_reduce(self.robot_belief.copy(), block_size=(self.resolution, self.resolution),
+                                                   func=np.min)
         self.frontiers = self.find_frontier()
         self.old_robot_belief = copy.deepcopy(self.robot_belief)
 
@@ -79,8 +88,9 @@ class Env():
 
         self.robot_belief = self.update_robot_belief(robot_position, self.sensor_range, self.robot_belief,
                                                      self.ground_truth)
-        self.downsampled_belief = block_reduce(self.robot_belief.copy(), block_size=(self.resolution, self.resolution),
-                                               func=np.min)
+        with stage('block_reduce'):
+            self.downsampled_belief = block_reduce(self.robot_belief.copy(), block_size=(self.resolution, self.resolution),
+                                                   func=np.min)
 
         frontiers = self.find_frontier()
         self.explored_rate = self.evaluate_exploration_rate()
@@ -168,6 +178,7 @@ class Env():
 
         return np.sum(new_free_area)
 
+    @timed('find_frontier')
     def find_frontier(self):
         # find frontiers from downsampled_belief by checking nearby 8 cells for each cell
         y_len = self.downsampled_belief.shape[0]
@@ -199,7 +210,25 @@ class Env():
 
         return f
 
+    @timed('plot')
+    def render_frame(self):
+        # same layers as _plot_env, composited into an RGB array without pyplot or disk I/O
+        frame = belief_image(self.robot_belief)
+        draw_points(frame, self.frontiers, (255, 0, 0), radius=1)
+        draw_points(frame, line_points(self.targets[-5:], dash=6), (0, 160, 0), radius=1)
+        draw_cross(frame, self.targets[-1], (0, 160, 0), size=5)
+        draw_points(frame, line_points(self.visited), (0, 0, 255), radius=1)
+        draw_disk(frame, self.visited[-1], (255, 0, 255), radius=5)
+        draw_disk(frame, self.visited[0], (0, 255, 255), radius=5)
+        draw_progress(frame, self.explored_rate, (0, 160, 0))
+        return frame
+
+    @timed('plot')
     def plot_env(self, n, path, step, travel_dist):
+        with plot_lock:
+            self._plot_env(n, path, step, travel_dist)
+
+    def _plot_env(self, n, path, step, travel_dist):
         plt.switch_backend('agg')
         # plt.ion()
         plt.cla()
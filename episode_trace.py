@@ -0,0 +1,161 @@
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg') # headless
+
+import argparse
+import time
+import zlib
+
+import numpy as np
+
+from env import Env
+from parameter import *
+
+
+'''
+Episode traces: the map, start position and every target position a Worker chose,
+plus a checksum of the robot belief, the reward and a checksum of the planned route
+after every env step. Traces are .npz files and this module does not import torch,
+so replaying one re-drives Env and the planner exactly like Worker.run_fragment,
+without a policy. Replays serve as deterministic simulator workloads and as a
+check that optimised code still matches the recorded behaviour:
+
+    python episode_trace.py train/<run>/traces/*.npz
+    python episode_trace.py --no-check --repeat 5 train/<run>/traces/episode_7.npz
+'''
+
+
+def belief_checksum(robot_belief):
+    return zlib.crc32(np.ascontiguousarray(robot_belief).tobytes())
+
+
+def route_checksum(route):
+    return zlib.crc32(repr(route).encode())
+
+
+class TraceRecorder:
+    # filled by a Worker while its episode runs
+    def __init__(self, env, k_size, max_timestep):
+        self.map_dir = env.map_dir
+        self.map_name = env.map_list[env.map_index]
+        self.map_index = env.map_index
+        self.test = env.test
+        self.start_position = np.array(env.start_position)
+        self.k_size = k_size
+        self.max_timestep = max_timestep
+        self.targets = []
+        self.rewards = []
+        self.belief_checksums = []
+        self.route_checksums = []
+
+    def target(self, target_position):
+        self.targets.append(np.array(target_position))
+
+    def step(self, reward, robot_belief, route):
+        self.rewards.append(reward)
+        self.belief_checksums.append(belief_checksum(robot_belief))
+        self.route_checksums.append(route_checksum(route))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez_compressed(path,
+                            map_dir=self.map_dir, map_name=self.map_name, map_index=self.map_index, test=self.test,
+                            start_position=self.start_position, k_size=self.k_size, max_timestep=self.max_timestep,
+                            num_action_step=NUM_ACTION_STEP, num_planning_step=NUM_PLANNING_STEP,
+                            targets=np.array(self.targets, dtype=np.int64).reshape(-1, 2),
+                            rewards=np.array(self.rewards, dtype=np.float64),
+                            belief_checksums=np.array(self.belief_checksums, dtype=np.uint32),
+                            route_checksums=np.array(self.route_checksums, dtype=np.uint32))
+
+
+def load_trace(path):
+    with np.load(path) as data:
+        trace = {key: data[key] for key in data.files}
+    for key in ['map_dir', 'map_name']:
+        trace[key] = str(trace[key])
+    for key in ['map_index', 'k_size', 'max_timestep', 'num_action_step', 'num_planning_step']:
+        trace[key] = int(trace[key])
+    trace['test'] = bool(trace['test'])
+    return trace
+
+
+def replay_trace(trace, check=True):
+    # re-drives the episode, returns the env steps run and the mismatches found
+    env = Env(trace['map_index'], k_size=trace['k_size'], test=trace['test'], map_dir=trace['map_dir'])
+    mismatches = []
+    if env.map_list[env.map_index] != trace['map_name']:
+        return 0, ['map {} is {} in this tree'.format(trace['map_name'], env.map_list[env.map_index])]
+    if check and not np.array_equal(env.start_position, trace['start_position']):
+        mismatches.append('start position {} != {}'.format(env.start_position, trace['start_position']))
+
+    targets = iter(trace['targets'])
+    robot_position = env.start_position
+    travel_dist = 0
+
+    def select_target():
+        target_position = next(targets)
+        return target_position, env.node_coords[env.find_index_from_coords(target_position)]
+
+    target_position, target_node_position = select_target()
+    for num_step in range(trace['max_timestep']):
+        planning_step = num_step // trace['num_action_step']
+        action_step = num_step % trace['num_action_step']
+
+        dist, route = env.graph_generator.find_shortest_path(robot_position, target_node_position, env.node_coords)
+        if route == [] or route == None:
+            next_position = robot_position
+        else:
+            next_position = env.node_coords[int(route[1])]
+        reward, done, robot_position, travel_dist = env.step(robot_position, next_position, target_position, travel_dist)
+
+        if check:
+            if num_step >= len(trace['rewards']):
+                mismatches.append('step {}: episode runs longer than the trace'.format(num_step))
+                break
+            if reward != trace['rewards'][num_step]:
+                mismatches.append('step {}: reward {} != {}'.format(num_step, reward, trace['rewards'][num_step]))
+            if belief_checksum(env.robot_belief) != trace['belief_checksums'][num_step]:
+                mismatches.append('step {}: robot belief differs'.format(num_step))
+            if route_checksum(route) != trace['route_checksums'][num_step]:
+                mismatches.append('step {}: route {} differs'.format(num_step, route))
+
+        if action_step == trace['num_action_step'] - 1 or done:
+            if done or planning_step == trace['num_planning_step'] - 1:
+                break
+            target_position, target_node_position = select_target()
+
+    num_steps = num_step + 1
+    if check and num_steps < len(trace['rewards']):
+        mismatches.append('episode ended after {} of {} steps'.format(num_steps, len(trace['rewards'])))
+    return num_steps, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay episode traces without torch')
+    parser.add_argument('traces', nargs='+', help='.npz traces written with TRACE_EVERY_N_EPISODES')
+    parser.add_argument('--no-check', action='store_true', help='only time the replay')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    failed = 0
+    total_steps, total_time = 0, 0.
+    for path in args.traces:
+        trace = load_trace(path)
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            num_steps, mismatches = replay_trace(trace, check=not args.no_check)
+            elapsed = time.perf_counter() - start
+            total_steps += num_steps
+            total_time += elapsed
+        status = 'OK' if not mismatches else 'MISMATCH'
+        print('{} {}: {} steps, {:.1f} steps/s'.format(status, path, num_steps, num_steps / elapsed))
+        for mismatch in mismatches[:10]:
+            print('    ' + mismatch)
+        failed += bool(mismatches)
+
+    print('{} traces, {} mismatched, {:.1f} steps/s overall'.format(len(args.traces), failed, total_steps / total_time))
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
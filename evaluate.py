@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+
+import backend
+from network import RL_Policy
+from resources import thread_env_vars
+from worker import Worker
+from parameter import *
+
+
+'''
+Evaluates a checkpoint on DungeonMaps splits in parallel across runners.
+
+Every finished map is appended as one JSON line to the results file, so an
+interrupted evaluation resumes with the maps that are still missing. --shard i/n
+evaluates every n-th map, letting several hosts split one evaluation and
+write to their own results files. At the end the results of this checkpoint,
+mode and seed are aggregated per split:
+
+    python evaluate.py --checkpoint model/<run>/checkpoint.pth --splits easy medium complex
+'''
+
+MAP_ROOT = 'DungeonMaps'
+
+
+class DeterministicPolicy(object):
+    # acts with the mode of the action distribution
+    def __init__(self, actor_critic):
+        self.actor_critic = actor_critic
+
+    def act(self, observations):
+        return self.actor_critic.act(observations, deterministic=True)
+
+
+class Evaluator(object):
+    def __init__(self, meta_agent_id, model_state, deterministic=True):
+        self.meta_agent_id = meta_agent_id
+        self.device = torch.device('cuda') if USE_GPU else torch.device('cpu')
+        self.actor_critic = RL_Policy(INPUT_DIM, 2, downscaling=OBS_DOWNSCALING, fast_inference=FAST_INFERENCE,
+                                      quantize=QUANTIZE_ROLLOUT).to(self.device)
+        self.actor_critic.load_state_dict(model_state)
+        self.policy = DeterministicPolicy(self.actor_critic) if deterministic else self.actor_critic
+
+    def evaluate(self, split, map_index, seed, save_image=False):
+        print("evaluating {} map {} on metaAgent {}".format(split, map_index, self.meta_agent_id))
+        # sampled actions are reproducible per map
+        torch.manual_seed(seed + map_index)
+        worker = Worker(self.meta_agent_id, self.policy, map_index, save_image=save_image,
+                        map_dir=os.path.join(MAP_ROOT, split))
+        worker.work(map_index)
+        return {'split': split,
+                'map_index': map_index,
+                'map': worker.env.map_list[worker.env.map_index],
+                'travel_dist': float(worker.perf_metrics['travel_dist']),
+                'explored_rate': float(worker.perf_metrics['explored_rate']),
+                'success': bool(worker.perf_metrics['success_rate']),
+                'steps': worker.num_step}
+
+
+def read_results(path, checkpoint, deterministic, seed):
+    # results of this checkpoint, mode and seed already in the results file
+    results = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if (record['checkpoint'], record['deterministic'], record['seed']) == (checkpoint, deterministic, seed):
+                    results.append(record)
+    return results
+
+
+def format_table(results, splits):
+    lines = ['{:<10}{:>6}{:>22}{:>24}{:>10}'.format('split', 'maps', 'explored rate', 'travel distance', 'success')]
+    for split in splits:
+        records = [record for record in results if record['split'] == split]
+        if not records:
+            continue
+        explored = np.array([record['explored_rate'] for record in records])
+        dist = np.array([record['travel_dist'] for record in records])
+        success = np.array([record['success'] for record in records])
+        lines.append('{:<10}{:>6}{:>14.3f} +- {:<5.3f}{:>14.1f} +- {:<6.1f}{:>9.1%}'.format(
+            split, len(records), explored.mean(), explored.std(), dist.mean(), dist.std(), success.mean()))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='parallel resumable evaluation on DungeonMaps splits')
+    parser.add_argument('--checkpoint', required=True, help='checkpoint.pth saved by driver.py')
+    parser.add_argument('--splits', nargs='+', default=['easy', 'medium', 'complex'], help='directories in DungeonMaps')
+    parser.add_argument('--results', default='evaluation_results.jsonl', help='append-only results file')
+    parser.add_argument('--runners', type=int, default=NUM_META_AGENT)
+    parser.add_argument('--max-maps', type=int, default=None, help='first maps of each split only')
+    parser.add_argument('--shard', default='0/1', help='i/n evaluates the maps whose index is i modulo n')
+    parser.add_argument('--stochastic', action='store_true', help='sample actions instead of the distribution mode')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gifs', action='store_true', help='save a gif of every evaluated map to gifs_path')
+    args = parser.parse_args()
+    deterministic = not args.stochastic
+    shard, num_shards = map(int, args.shard.split('/'))
+
+    done = {(record['split'], record['map_index']) for record in read_results(args.results, args.checkpoint, deterministic, args.seed)}
+    pending = []
+    for split in args.splits:
+        num_maps = len(os.listdir(os.path.join(MAP_ROOT, split)))
+        if args.max_maps is not None:
+            num_maps = min(num_maps, args.max_maps)
+        pending += [(split, i) for i in range(num_maps) if i % num_shards == shard and (split, i) not in done]
+    print("{} maps evaluated, {} to go".format(len(done), len(pending)))
+
+    if pending:
+        backend.init(EXECUTION_BACKEND)
+        checkpoint = torch.load(args.checkpoint, map_location=torch.device('cpu'))
+        # the GPUs are split over the evaluators, so more than NUM_META_AGENT still fit
+        num_evaluators = min(args.runners, len(pending))
+        evaluators = [backend.create_actor(Evaluator, i, checkpoint['policy_model'], deterministic,
+                                           env_vars=thread_env_vars('runner', i),
+                                           num_cpus=RUNNER_NUM_THREADS, num_gpus=NUM_GPU / num_evaluators if USE_GPU else 0)
+                      for i in range(num_evaluators)]
+        if args.gifs:
+            os.makedirs(gifs_path, exist_ok=True)
+
+        job_owner = {}
+        for i, evaluator in enumerate(evaluators):
+            split, map_index = pending.pop(0)
+            job_owner[evaluator.evaluate.remote(split, map_index, args.seed, args.gifs)] = i
+
+        try:
+            with open(args.results, 'a') as f:
+                while job_owner:
+                    done_id, _ = backend.wait(list(job_owner))
+                    i = job_owner.pop(done_id[0])
+                    record = backend.get(done_id[0])
+                    record.update({'checkpoint': args.checkpoint, 'deterministic': deterministic, 'seed': args.seed})
+                    # one line per map, flushed so an interrupted run keeps every finished map
+                    f.write(json.dumps(record) + '\n')
+                    f.flush()
+                    if pending:
+                        split, map_index = pending.pop(0)
+                        job_owner[evaluators[i].evaluate.remote(split, map_index, args.seed, args.gifs)] = i
+        except KeyboardInterrupt:
+            print("CTRL_C pressed. Finished maps are kept in {}".format(args.results))
+        finally:
+            for evaluator in evaluators:
+                backend.kill(evaluator)
+
+    print(format_table(read_results(args.results, args.checkpoint, deterministic, args.seed), args.splits))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
+from timing import timed
+
+
 class Edge:
     def __init__(self, to_node, length):
         self.to_node = to_node
@@ -36,6 +39,7 @@ def h(index, destination, node_coords):
     return h
 
 
+@timed('a_star')
 def a_star(start, destination, node_coords, graph):
     if start == destination:
         return [], 0
@@ -5,6 +5,7 @@ import copy
 from parameter import *
 from node import Node
 from graph import Graph, a_star
+from timing import timed
 
 
 class Graph_generator:
@@ -43,6 +44,7 @@ class Graph_generator:
 
         return self.node_coords, self.graph.edges
 
+    @timed('update_graph')
     def update_graph(self, robot_belief, old_robot_belief):
         # add uniform points in the new free area to the node coords
         new_free_area = self.free_area((robot_belief - old_robot_belief > 0) * 255)
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import numpy as np
+import ray
+import torch
+
+import backend
+from network import RL_Policy
+from observation import compress_observations, expand_observations
+from weights import WeightReceiver
+from parameter import *
+
+
+class InferenceServer(object):
+    # Holds the only rollout copy of the policy and evaluates observations sent by all
+    # runners in batches of up to max_batch, waiting at most max_latency for a batch to fill
+    def __init__(self, max_batch=INFERENCE_MAX_BATCH, max_latency=INFERENCE_MAX_LATENCY):
+        self.device = torch.device('cuda') if USE_GPU else torch.device('cpu')
+        self.actor_critic = RL_Policy(INPUT_DIM, 2, downscaling=OBS_DOWNSCALING, fast_inference=FAST_INFERENCE,
+                                      quantize=QUANTIZE_ROLLOUT).to(self.device)
+        self.weight_receiver = WeightReceiver()
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+
+        self.pending = [] # requests waiting for the next batch
+        self.condition = threading.Condition()
+        self.model_lock = threading.Lock() # weights are not swapped during a forward pass
+
+        self.batcher = threading.Thread(target=self.run, daemon=True)
+        self.batcher.start()
+
+    def set_weights(self, weights_packet):
+        with self.model_lock:
+            self.weight_receiver.load(self.actor_critic, weights_packet)
+
+    def get_version(self):
+        return self.weight_receiver.version
+
+    def act(self, stored_observations):
+        # called concurrently by the runners, blocks until the batch holding this request is evaluated
+        request = {'observations': stored_observations, 'done': threading.Event()}
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+        request['done'].wait()
+        return request['result']
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.max_latency
+                while len(self.pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending[:self.max_batch]
+                self.pending = self.pending[self.max_batch:]
+
+            stored = torch.from_numpy(np.stack([request['observations'] for request in batch])).to(self.device)
+            with self.model_lock:
+                values, actions, action_log_probs = self.actor_critic.act_batch(expand_observations(stored))
+                version = self.weight_receiver.version
+            values, actions, action_log_probs = values.cpu(), actions.cpu(), action_log_probs.cpu()
+
+            for i, request in enumerate(batch):
+                request['result'] = (values[i], actions[i], action_log_probs[i], version)
+                request['done'].set()
+
+
+class RemotePolicy(object):
+    # Stands in for RL_Policy in a Worker, forwarding act to the inference server
+    def __init__(self, inference_server):
+        self.inference_server = inference_server
+
+    def act_with_version(self, observations):
+        # observations travel in the compact storage layout, the server returns the policy version that acted
+        stored_observations = compress_observations(observations).cpu().numpy()
+        return backend.get(self.inference_server.act.remote(stored_observations))
+
+    def act(self, observations):
+        return self.act_with_version(observations)[:3]
+
+
+@ray.remote(num_cpus=1, num_gpus=NUM_GPU if USE_GPU else 0)
+class RLInferenceServer(InferenceServer):
+    def __init__(self):
+        super().__init__()
@@ -0,0 +1,179 @@
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+from torch.optim import Adam
+
+from network import RL_Policy
+from observation import expand_observations, storage_dtype, storage_shape
+from resources import configure_threads
+from weights import cpu_state_dict
+from parameter import *
+
+
+class PPOLearner:
+    # Clipped PPO updates on a sampled minibatch. With world_size > 1 every rank holds one
+    # shard of the minibatch: losses are scaled by the shard's share of the batch and the
+    # gradients summed across ranks, which gives the same update as the whole batch on one rank
+    def __init__(self, actor_critic, optimizer, rank=0, world_size=1):
+        self.actor_critic = actor_critic
+        self.optimizer = optimizer
+        self.rank = rank
+        self.world_size = world_size
+
+    def all_reduce(self, tensor):
+        if self.world_size > 1:
+            dist.all_reduce(tensor)
+        return tensor
+
+    def all_reduce_gradients(self):
+        # one collective for all gradients
+        grads = [param.grad for param in self.actor_critic.parameters()]
+        flat = self.all_reduce(torch.cat([grad.reshape(-1) for grad in grads]))
+        offset = 0
+        for grad in grads:
+            grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+            offset += grad.numel()
+
+    def update(self, rollouts, batch_size=None):
+        # rollouts are (observations, actions, log probs, rewards, returns) of this rank's shard,
+        # batch_size is the size of the whole minibatch
+        batch_obs, batch_acts, batch_log_probs, _, batch_returns = rollouts
+        batch_size = batch_size or len(batch_obs)
+        shard_weight = len(batch_obs) / batch_size
+        # a minibatch smaller than world_size leaves some shards empty. They skip the network, whose
+        # means would be NaN, and contribute zero losses and gradients but still join every all-reduce
+        empty_shard = len(batch_obs) == 0
+
+        # Calculate advantage, normalised over the whole minibatch
+        curr_values = torch.zeros_like(batch_returns) if empty_shard else self.actor_critic.get_value(batch_obs)
+        A_k = batch_returns - curr_values
+        A_mean = self.all_reduce(A_k.sum()) / batch_size
+        A_std = (self.all_reduce((A_k - A_mean).pow(2).sum()) / (batch_size - 1)).sqrt()
+        A_k = (A_k - A_mean) / (A_std + 1e-10) #NOTE MIGHT NOT HAVE TO NORMALISE
+
+        # training for n times each step
+        for _ in range(N_UPDATES_PER_ITERATIONS):
+
+            if not empty_shard:
+                # Calculate V_phi and pi_theta(a_t | s_t)
+                curr_values, curr_log_probs, dist_entropy = self.actor_critic.evaluate_actions(batch_obs, batch_acts)
+
+                # Calculate surrogate losses.
+                ratios = torch.exp(curr_log_probs - batch_log_probs)
+                surr1 = ratios * A_k
+                surr2 = torch.clamp(ratios, 1 - CLIP, 1 + CLIP) * A_k
+
+                # Calculate actor and critic losses, as this shard's share of the minibatch means
+                actor_loss = (-torch.min(surr1, surr2)).mean() * shard_weight
+                critic_loss = nn.MSELoss()(curr_values, batch_returns) * shard_weight
+                dist_entropy = dist_entropy * shard_weight
+            else:
+                actor_loss = critic_loss = dist_entropy = sum(param.sum() for param in self.actor_critic.parameters()) * 0
+
+            ''' Clipped Critic Loss'''
+            # value_pred_clipped = V_old.detach() + (V - V_old.detach()).clamp(-CLIP, CLIP)
+            # value_losses = (V - batch_returns).pow(2)
+            # value_losses_clipped = (value_pred_clipped - batch_returns).pow(2)
+            # critic_loss = torch.max(value_losses, value_losses_clipped).mean()
+
+            actor_critic_loss = actor_loss\
+                + critic_loss * CRITIC_LOSS_COEF\
+                - dist_entropy * ENTROPY_COEF
+
+            # Calculate gradients and perform backward propagation for actor critic network
+            self.optimizer.zero_grad()
+            actor_critic_loss.backward()
+            self.all_reduce_gradients()
+            actor_critic_grad_norm = nn.utils.clip_grad_norm_(self.actor_critic.parameters(),
+                                    max_norm=MAX_GRAD_NORM, norm_type=2)
+            self.optimizer.step()
+
+            '''Check Gradients'''
+            # total_norm = 0
+            # for name, param in self.actor_critic.named_parameters():
+            #     if param.grad is not None:
+            #         print(f'Parameter: {name}, Gradient Norm: {param.grad.norm()}')
+            #         param_norm = param.grad.norm()
+            #         total_norm += param_norm.item() ** 2
+            # total_norm = total_norm ** (1. / 2)
+            # print(f"total norm {total_norm}")
+
+        # losses of the last update over the whole minibatch
+        losses = self.all_reduce(torch.stack([actor_loss, critic_loss, dist_entropy]).detach())
+        return (*losses.tolist(), actor_critic_grad_norm.item())
+
+
+def share_batch(rank, world_size, stored_rollouts=None):
+    # Rank 0 broadcasts a minibatch sampled from the replay buffer, with observations still in the
+    # compact storage layout, and every rank returns its own shard. A batch size of 0 means stop
+    header = torch.tensor([len(stored_rollouts[0]) if stored_rollouts is not None else 0])
+    dist.broadcast(header, 0)
+    batch_size = header.item()
+    if batch_size == 0:
+        return None, 0
+
+    if rank == 0:
+        observations, actions, log_probs, rewards, returns = stored_rollouts
+        observations = observations.contiguous()
+        values = torch.cat([actions, log_probs[:, None], rewards[:, None], returns[:, None]], 1).contiguous()
+    else:
+        observations = torch.empty((batch_size, *storage_shape(OBS_DIM)), dtype=storage_dtype())
+        values = torch.empty((batch_size, 2 + 3))
+    dist.broadcast(observations, 0)
+    dist.broadcast(values, 0)
+
+    shard = torch.tensor_split(torch.arange(batch_size), world_size)[rank]
+    start, end = (shard[0].item(), shard[-1].item() + 1) if len(shard) else (0, 0)
+    values = values[start:end]
+    rollouts = [expand_observations(observations[start:end]), values[:, :2].contiguous(),
+                values[:, 2].contiguous(), values[:, 3].contiguous(), values[:, 4].contiguous()]
+    return rollouts, batch_size
+
+
+class DataParallelLearner(PPOLearner):
+    # Rank 0 of a data-parallel learner on this host. The other ranks run in their own
+    # processes with a replica of the model and optimizer and receive every minibatch over gloo.
+    # Replicas start from the same state and apply the same summed gradients, so they stay in sync
+    def __init__(self, actor_critic, optimizer, num_processes=LEARNER_PROCESSES, port=LEARNER_PORT):
+        super().__init__(actor_critic, optimizer, 0, num_processes)
+        context = mp.get_context('spawn')
+        model_state = cpu_state_dict(actor_critic.state_dict())
+        optimizer_state = optimizer.state_dict()
+        self.processes = [context.Process(target=run_learner_rank, daemon=True,
+                                          args=(rank, num_processes, port, model_state, optimizer_state))
+                          for rank in range(1, num_processes)]
+        for process in self.processes:
+            process.start()
+        dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port),
+                                rank=0, world_size=num_processes)
+
+    def update(self, stored_rollouts):
+        # stored_rollouts is a minibatch sampled on CPU with observations in the storage layout
+        rollouts, batch_size = share_batch(self.rank, self.world_size, stored_rollouts)
+        return super().update(rollouts, batch_size)
+
+    def stop(self):
+        share_batch(self.rank, self.world_size)
+        for process in self.processes:
+            process.join()
+        dist.destroy_process_group()
+
+
+def run_learner_rank(rank, world_size, port, model_state, optimizer_state):
+    # entry point of the learner processes other than rank 0
+    configure_threads('learner', rank)
+    actor_critic = RL_Policy(INPUT_DIM, 2, downscaling=OBS_DOWNSCALING)
+    actor_critic.load_state_dict(model_state)
+    optimizer = Adam(actor_critic.parameters(), lr=LR, eps=1e-5)
+    optimizer.load_state_dict(optimizer_state)
+
+    learner = PPOLearner(actor_critic, optimizer, rank, world_size)
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port),
+                            rank=rank, world_size=world_size)
+    while True:
+        rollouts, batch_size = share_batch(rank, world_size)
+        if rollouts is None:
+            break
+        learner.update(rollouts, batch_size)
+    dist.destroy_process_group()
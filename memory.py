@@ -0,0 +1,131 @@
+import io
+import math
+import resource
+import time
+import warnings
+import weakref
+
+import numpy as np
+import torch
+
+from parameter import *
+
+
+'''
+Memory accounting for the driver and runners. Runners report their resident
+memory, model and episode buffer bytes with every job, the driver adds its own
+resident memory, the replay buffer and the finished results waiting for
+ingestion. With MEMORY_BUDGET set, a total over budget first trims the replay
+buffer, down to MINIMUM_BUFFER_SIZE rows, then throttles job dispatch.
+'''
+
+MB = 2 ** 20
+
+rollout_head_sizes = weakref.WeakKeyDictionary() # policy -> bytes of its rollout copy, measured once
+
+
+def resident_bytes():
+    # anonymous and shared memory resident in this process. File-backed pages, e.g. the
+    # memory-mapped replay observations, are left out, the kernel can drop them at any time
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return sum(int(fields[key].split()[0]) * 1024 for key in ('RssAnon', 'RssShmem'))
+    except (OSError, KeyError, ValueError):
+        # peak rather than current resident memory, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def nested_nbytes(obj):
+    # bytes of the tensors and arrays in nested lists, tuples and dicts
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(nested_nbytes(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nested_nbytes(value) for value in obj)
+    return 0
+
+
+def serialized_nbytes(module):
+    # frozen TorchScript and int8 modules keep their weights outside parameters(), their saved size stands in
+    buffer = io.BytesIO()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        if isinstance(module, torch.jit.ScriptModule):
+            torch.jit.save(module, buffer)
+        else:
+            torch.save(module.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def module_nbytes(module):
+    # with FAST_INFERENCE or QUANTIZE_ROLLOUT an RL_Policy also holds a separate rollout copy. It is
+    # rebuilt after every weight load with the same shapes, so its size is measured for the first copy only
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    nbytes = nested_nbytes(list(module.parameters()) + list(module.buffers()))
+    rollout_head = getattr(module, 'rollout_head', None)
+    if rollout_head is not None and module not in rollout_head_sizes:
+        rollout_head_sizes[module] = serialized_nbytes(rollout_head)
+    return nbytes + rollout_head_sizes.get(module, 0)
+
+
+class MemoryMonitor:
+    # Called from the training loop, measures every interval seconds and enforces the budget
+    def __init__(self, replay_buffer, collector, ingestor, budget=MEMORY_BUDGET, min_replay_size=MINIMUM_BUFFER_SIZE,
+                 interval=MEMORY_CHECK_INTERVAL):
+        self.replay_buffer = replay_buffer
+        self.collector = collector
+        self.ingestor = ingestor
+        self.budget = budget
+        self.min_replay_size = min_replay_size
+        self.interval = interval
+        self.last_check = 0.
+
+    def usage(self):
+        runners = list(self.ingestor.runner_memory.values())
+        return {'driver_rss': resident_bytes(),
+                'runner_rss': sum(memory['rss'] for memory in runners),
+                'runner_models': sum(memory['model'] for memory in runners),
+                'runner_episode_buffers': sum(memory['episode_buffers'] for memory in runners),
+                'replay_buffer': self.replay_buffer.nbytes - self.replay_buffer.disk_nbytes,
+                'replay_capacity': self.replay_buffer.capacity,
+                'pending_results': self.ingestor.jobs.qsize() * self.ingestor.result_bytes,
+                'jobs_in_flight': len(self.collector.job_list)}
+
+    def check(self):
+        if self.budget <= 0 or time.time() - self.last_check < self.interval:
+            return
+        self.last_check = time.time()
+        usage = self.usage()
+        total = usage['driver_rss'] + usage['runner_rss']
+        over = total - self.budget
+
+        if over > 0:
+            replay = self.replay_buffer
+            row_bytes = usage['replay_buffer'] / replay.capacity
+            capacity = max(self.min_replay_size, replay.capacity - math.ceil(over / row_bytes))
+            if capacity < replay.capacity:
+                print("Memory {:.0f} MB over budget, trimming the replay buffer to {} rows".format(over / MB, capacity))
+                replay.resize(capacity)
+            elif self.collector.max_in_flight > 1:
+                print("Memory {:.0f} MB over budget, throttling dispatch to {} jobs".format(
+                    over / MB, self.collector.max_in_flight // 2))
+                self.collector.set_max_in_flight(self.collector.max_in_flight // 2)
+        elif total < 0.9 * self.budget and self.collector.max_in_flight < self.collector.num_slots:
+            # the replay buffer stays trimmed, only dispatch recovers
+            self.collector.set_max_in_flight(self.collector.max_in_flight * 2)
+
+
+def write_memory_usage(writer, usage, global_step):
+    writer.add_scalar(tag='Memory/Driver RSS MB', scalar_value=usage['driver_rss'] / MB, global_step=global_step)
+    writer.add_scalar(tag='Memory/Runners RSS MB', scalar_value=usage['runner_rss'] / MB, global_step=global_step)
+    writer.add_scalar(tag='Memory/Runner Models MB', scalar_value=usage['runner_models'] / MB, global_step=global_step)
+    writer.add_scalar(tag='Memory/Runner Episode Buffers MB', scalar_value=usage['runner_episode_buffers'] / MB, global_step=global_step)
+    writer.add_scalar(tag='Memory/Replay Buffer MB', scalar_value=usage['replay_buffer'] / MB, global_step=global_step)
+    writer.add_scalar(tag='Memory/Replay Capacity', scalar_value=usage['replay_capacity'], global_step=global_step)
+    writer.add_scalar(tag='Memory/Pending Results MB', scalar_value=usage['pending_results'] / MB, global_step=global_step)
+    writer.add_scalar(tag='Memory/Jobs In Flight', scalar_value=usage['jobs_in_flight'], global_step=global_step)
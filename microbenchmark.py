@@ -0,0 +1,184 @@
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg') # headless
+
+import argparse
+import copy
+import json
+import sys
+import time
+
+import numpy as np
+
+from env import Env
+from graph import a_star
+from graph_generator import Graph_generator
+from sensor import sensor_work
+from worker import Worker
+from parameter import *
+
+
+'''
+Microbenchmarks of the simulator and planner hot paths on fixed DungeonMaps.
+
+Each map is explored for a few steps towards seeded random graph nodes and every
+step is recorded, so all benchmarks time the same inputs on every run. Results
+are ops/s and p50/p99 latencies, optionally compared to a JSON baseline:
+
+    python microbenchmark.py --save-baseline microbenchmark_baseline.json
+    python microbenchmark.py --baseline microbenchmark_baseline.json --threshold 0.2
+
+A benchmark fails when its p50 is more than threshold (a fraction) slower than the
+baseline. Per benchmark thresholds can be set under "thresholds" in the baseline file.
+'''
+
+
+def record_steps(map_index, num_steps, seed):
+    # robot walks to seeded random nodes, returns the environment before each step and what the step produced
+    env = Env(map_index, k_size=K_SIZE)
+    rng = np.random.RandomState(seed)
+    position = env.start_position
+    steps = []
+    for _ in range(num_steps):
+        target = env.node_coords[rng.randint(len(env.node_coords))]
+        _, route = env.graph_generator.find_shortest_path(position, target, env.node_coords)
+        next_position = env.node_coords[int(route[1])] if route else position
+        before = copy.deepcopy(env)
+        env.step(position, next_position, target, 0)
+        steps.append({'env': before, 'position': position, 'next_position': next_position, 'target': target,
+                      'frontiers': env.frontiers.copy(), 'robot_belief': env.robot_belief.copy()})
+        position = next_position
+    return steps
+
+
+def make_benchmarks(maps, num_steps, seed):
+    # name -> (function making one untimed call from a case, cases)
+    steps, starts, workers = [], [], []
+    for map_index in maps:
+        map_steps = record_steps(map_index, num_steps, seed)
+        steps += map_steps
+        start = map_steps[0]['env']
+        starts.append(start)
+        worker = Worker(0, None, map_index)
+        workers += [worker] * len(map_steps)
+
+    def call_sensor_work(step):
+        belief = step['env'].robot_belief.copy()
+        env = step['env']
+        return lambda: sensor_work(step['next_position'], env.sensor_range, belief, env.ground_truth)
+
+    def call_calculate_reward(step):
+        env = step['env']
+        dist = np.linalg.norm(step['position'] - step['next_position'])
+        same_position = step['position'] == step['next_position']
+        return lambda: env.calculate_reward(dist, step['frontiers'], same_position)
+
+    def call_generate_graph(env):
+        generator = Graph_generator(map_size=env.ground_truth_size, sensor_range=env.sensor_range, k_size=K_SIZE)
+        return lambda: generator.generate_graph(env.start_position, env.robot_belief)
+
+    def call_update_graph(step):
+        generator = copy.deepcopy(step['env'].graph_generator)
+        return lambda: generator.update_graph(step['robot_belief'], step['env'].robot_belief)
+
+    def call_a_star(step):
+        generator = step['env'].graph_generator
+        start = generator.find_index_from_coords(generator.node_coords, step['position'])
+        destination = generator.find_index_from_coords(generator.node_coords, step['target'])
+        return lambda: a_star(int(start), int(destination), generator.node_coords, generator.graph)
+
+    def call_get_observations(case):
+        step, worker = case
+        worker.env, worker.robot_position = step['env'], step['position']
+        return worker.get_observations
+
+    def call_env_step(step):
+        env = copy.deepcopy(step['env'])
+        return lambda: env.step(step['position'], step['next_position'], step['target'], 0)
+
+    return {
+        'sensor_work': (call_sensor_work, steps),
+        'find_frontier': (lambda step: step['env'].find_frontier, steps),
+        'calculate_reward': (call_calculate_reward, steps),
+        'generate_graph': (call_generate_graph, starts),
+        'update_graph': (call_update_graph, steps),
+        'a_star': (call_a_star, steps),
+        'get_observations': (call_get_observations, list(zip(steps, workers))),
+        'env_step': (call_env_step, steps),
+    }
+
+
+def measure(make_call, cases, repeat):
+    latencies = []
+    for _ in range(repeat):
+        for case in cases:
+            call = make_call(case)
+            start = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies)
+    return {'calls': len(latencies),
+            'ops_per_s': len(latencies) / latencies.sum(),
+            'p50_ms': 1000 * np.percentile(latencies, 50),
+            'p99_ms': 1000 * np.percentile(latencies, 99)}
+
+
+def compare(results, baseline, threshold):
+    # names of benchmarks whose p50 regressed by more than their threshold
+    thresholds = baseline.get('thresholds', {})
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        slowdown = result['p50_ms'] / base['p50_ms'] - 1
+        result['p50_change'] = slowdown
+        if slowdown > thresholds.get(name, threshold):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='simulator and planner microbenchmarks')
+    parser.add_argument('--maps', type=int, nargs='+', default=[0, 1, 2], help='DungeonMaps/train indices')
+    parser.add_argument('--steps', type=int, default=8, help='recorded steps per map')
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the recorded cases')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', default=None, help='benchmarks to run')
+    parser.add_argument('--baseline', default=None, help='JSON baseline to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed fractional p50 slowdown')
+    parser.add_argument('--save-baseline', default=None, help='write the results as a baseline')
+    parser.add_argument('--output', default=None, help='write the results as JSON')
+    args = parser.parse_args()
+
+    benchmarks = make_benchmarks(args.maps, args.steps, args.seed)
+    results = {}
+    for name, (make_call, cases) in benchmarks.items():
+        if args.only is None or name in args.only:
+            results[name] = measure(make_call, cases, args.repeat)
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    print('{:<20}{:>8}{:>12}{:>12}{:>12}{:>12}'.format('benchmark', 'calls', 'ops/s', 'p50 ms', 'p99 ms', 'p50 change'))
+    for name, result in results.items():
+        change = '{:+.1%}'.format(result['p50_change']) if 'p50_change' in result else '-'
+        print('{:<20}{:>8}{:>12.1f}{:>12.3f}{:>12.3f}{:>12}{}'.format(
+            name, result['calls'], result['ops_per_s'], result['p50_ms'], result['p99_ms'], change,
+            '  REGRESSION' if name in regressions else ''))
+
+    report = {'maps': args.maps, 'steps': args.steps, 'repeat': args.repeat, 'seed': args.seed, 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
+import copy
+import warnings
+
 import torch
 from torch import nn
 
@@ -13,8 +16,12 @@ class Global_Policy(nn.Module):
          
         out_size = int(input_shape[1] / 16. * input_shape[2] / 16.)
 
+        # downscaling=2 takes observations that are already pooled, so the first
+        # pool is an identity. Layer indices are unchanged and checkpoints load
+        # into either layout as is
+        assert downscaling in (1, 2)
         self.main = nn.Sequential(
-            nn.MaxPool2d(2),
+            nn.MaxPool2d(2) if downscaling == 1 else nn.Identity(),
             nn.Conv2d(8, 32, 3, stride=1, padding=1),
             nn.ReLU(),
             nn.MaxPool2d(2),
@@ -46,28 +53,118 @@ class Global_Policy(nn.Module):
         # squeeze -1 removes dimension of size 1 along last axis of tensor to remove singleton
 
 
+class PolicyHead(nn.Module):
+    # value and action mean in one graph, the std of DiagGaussian does not depend on the observation
+    def __init__(self, network, fc_mean):
+        super(PolicyHead, self).__init__()
+        self.network = network
+        self.fc_mean = fc_mean
+
+    def forward(self, observations):
+        value, actor_features = self.network(observations)
+        return value, self.fc_mean(actor_features)
+
+
+@torch.jit.script
+def sample_diag_gaussian(mean, logstd):
+    # draws from the same distribution as DiagGaussian(...).sample() and returns its log_probs,
+    # without building a Normal. 0.9189... is log(sqrt(2 * pi))
+    noise = torch.randn_like(mean)
+    action = mean + noise * logstd.exp()
+    log_probs = (-0.5 * noise * noise - logstd - 0.9189385332046727).sum(-1)
+    return action, log_probs
+
+
 class RL_Policy(nn.Module):
 
-    def __init__(self, obs_shape, action_dim):
+    def __init__(self, obs_shape, action_dim, downscaling=1, fast_inference=False, quantize=False):
         super(RL_Policy, self).__init__()
-        self.network = Global_Policy(obs_shape,hidden_size=HIDDEN_SIZE)
+        self.network = Global_Policy(obs_shape,hidden_size=HIDDEN_SIZE, downscaling=downscaling)
 
         self.action_dim = action_dim
         self.dist = DiagGaussian(self.network.output_size, action_dim)
 
+        # with fast_inference or quantize, act and act_batch run a separate rollout copy of the
+        # network: traced, frozen and channels-last and/or with int8 dynamically quantized linear
+        # layers. It is rebuilt from the current weights on the first call after every load_state_dict
+        self.obs_shape = (obs_shape[0], obs_shape[1] // downscaling, obs_shape[2] // downscaling)
+        self.fast_inference = fast_inference
+        self.quantize = quantize
+        self.rollout_head = None
+        self.rollout_logstd = None
+
     def forward(self, observations):
         return self.network(observations)
-    
-    def act(self, observations):
+
+    def load_state_dict(self, state_dict, strict=True):
+        result = super(RL_Policy, self).load_state_dict(state_dict, strict)
+        self.rollout_head = None
+        return result
+
+    def build_rollout_head(self):
+        device = self.dist.fc_mean.weight.device
+        head = copy.deepcopy(PolicyHead(self.network, self.dist.fc_mean)).eval()
+        if self.quantize:
+            # int8 weights with activations quantized on the fly, the learner keeps training in fp32
+            assert device.type == 'cpu', "quantized rollout policies run on CPU"
+            head = torch.ao.quantization.quantize_dynamic(head, {nn.Linear}, dtype=torch.qint8)
+        if self.fast_inference:
+            head = head.to(memory_format=torch.channels_last)
+            example = torch.zeros((1, *self.obs_shape), device=device).to(memory_format=torch.channels_last)
+            # newer torch versions warn that TorchScript is deprecated on every trace
+            with torch.no_grad(), warnings.catch_warnings():
+                warnings.simplefilter('ignore', FutureWarning)
+                head = torch.jit.freeze(torch.jit.trace(head, example))
+        # set around nn.Module so the copy is not registered as a submodule of the policy and stays
+        # out of state_dict, parameters() and to()
+        object.__setattr__(self, 'rollout_head', head)
+        self.rollout_logstd = self.dist.logstd._bias.detach().view(-1).clone()
+
+    def rollout_mean(self, batch_obs):
+        # value and action mean from the rollout copy
+        if self.rollout_head is None:
+            self.build_rollout_head()
+        with torch.inference_mode():
+            if self.fast_inference:
+                batch_obs = batch_obs.contiguous(memory_format=torch.channels_last)
+            return self.rollout_head(batch_obs)
+
+    def rollout_act(self, batch_obs, deterministic=False):
+        value, action_mean = self.rollout_mean(batch_obs)
+        with torch.inference_mode():
+            if deterministic:
+                action = action_mean
+                action_log_probs = FixedNormal(action_mean, self.rollout_logstd.exp()).log_probs(action)
+            else:
+                action, action_log_probs = sample_diag_gaussian(action_mean, self.rollout_logstd)
+        return value, action, action_log_probs
+
+    def act(self, observations, deterministic=False):
+        # deterministic takes the mode of the action distribution, e.g. for evaluation
+        if self.fast_inference or self.quantize:
+            value, action, action_log_probs = self.rollout_act(observations.unsqueeze(0), deterministic)
+            return value[0], action[0], action_log_probs[0]
         with torch.no_grad():
             value, actor_features = self(observations.unsqueeze(0)) #add batch dimension
             dist = self.dist(actor_features)
-            action = dist.sample().squeeze() # squeeze because it was made for multibatch input
+            action = dist.mode() if deterministic else dist.sample()
+            action = action.squeeze() # squeeze because it was made for multibatch input
             action_log_probs = dist.log_probs(action).squeeze()
             # print(f"action {action}")
             # print(f"logprobs {action_log_probs}")
         return value.squeeze().detach(), action.detach(), action_log_probs.detach()
 
+    def act_batch(self, batch_obs):
+        # act on a batch of observations, e.g. requests gathered by the inference server
+        if self.fast_inference or self.quantize:
+            return self.rollout_act(batch_obs)
+        with torch.no_grad():
+            value, actor_features = self(batch_obs)
+            dist = self.dist(actor_features)
+            action = dist.sample()
+            action_log_probs = dist.log_probs(action)
+        return value.detach(), action.detach(), action_log_probs.detach()
+
     def get_value(self, batch_obs):
         with torch.no_grad():
             value, _ = self(batch_obs)
@@ -84,7 +181,8 @@ class RL_Policy(nn.Module):
 
 class Flatten(nn.Module):
     def forward(self, x):
-        return x.view(x.size(0), -1)
+        # reshape keeps the NCHW flattening order for channels-last inputs too
+        return x.reshape(x.size(0), -1)
     
 # https://github.com/ikostrikov/pytorch-a2c-ppo-acktr-gail/blob/master/a2c_ppo_acktr/utils.py#L32
 class AddBias(nn.Module):
@@ -0,0 +1,41 @@
+import torch
+
+from parameter import *
+
+
+# Every observation channel is binary, so observations can be stored compactly:
+# 'float' keeps the raw float32 tensor, 'uint8' stores one byte per cell and
+# 'bitpack' stores eight cells per byte along the width axis
+_BIT_SHIFTS = torch.arange(7, -1, -1, dtype=torch.uint8)
+_BIT_WEIGHTS = torch.tensor([1 << s for s in range(7, -1, -1)], dtype=torch.uint8)
+
+
+def storage_dtype(storage=OBS_STORAGE):
+    return torch.float if storage == 'float' else torch.uint8
+
+
+def storage_shape(obs_shape, storage=OBS_STORAGE):
+    # shape of a single stored observation
+    if storage == 'bitpack':
+        assert obs_shape[-1] % 8 == 0, "observation width must be a multiple of 8 to bitpack"
+        return (*obs_shape[:-1], obs_shape[-1] // 8)
+    return tuple(obs_shape)
+
+
+def compress_observations(observations, storage=OBS_STORAGE):
+    # (..., C, H, W) float observations -> stored layout
+    if storage == 'float':
+        return observations
+    if storage == 'uint8':
+        return observations.to(torch.uint8)
+    bits = (observations > 0.5).to(torch.uint8)
+    bits = bits.view(*bits.shape[:-1], bits.shape[-1] // 8, 8)
+    return (bits * _BIT_WEIGHTS.to(bits.device)).sum(-1, dtype=torch.uint8)
+
+
+def expand_observations(stored, storage=OBS_STORAGE):
+    # stored layout -> (..., C, H, W) float observations, run on the training device
+    if storage != 'bitpack':
+        return stored.float()
+    bits = (stored.unsqueeze(-1) >> _BIT_SHIFTS.to(stored.device)) & 1
+    return bits.view(*stored.shape[:-1], stored.shape[-1] * 8).float()
@@ -4,7 +4,19 @@ from datetime import datetime
 USE_GPU = False  # do you want to collect training data using GPUs
 USE_GPU_GLOBAL = True  # do you want to train the network using GPUs
 NUM_GPU = 1
+FAST_INFERENCE = False # rollouts act through a traced channels-last policy with fused action sampling
+QUANTIZE_ROLLOUT = False # rollouts act with int8 linear layers (CPU only), check the drift with quantization_drift.py
 NUM_META_AGENT = 4 # 4 for laptop 8 for desktop
+RUNNER_NUM_THREADS = 1 # torch, OpenMP and BLAS threads of each runner process
+LEARNER_NUM_THREADS = 0 # threads of the driver's learner, 0 uses the cores left after the runners
+PIN_CPU_AFFINITY = False # pin each runner and the learner to their own cores
+EXECUTION_BACKEND = 'ray' # 'ray', or 'local' for single node multiprocessing with shared memory and no Ray services
+ENVS_PER_RUNNER = 1 # environments each runner advances concurrently on its threads with one shared policy
+
+'''INFERENCE SERVER PARAMETERS'''
+USE_INFERENCE_SERVER = False # runners only simulate and query one shared batched policy actor
+INFERENCE_MAX_BATCH = NUM_META_AGENT * ENVS_PER_RUNNER # most observations evaluated in one forward pass
+INFERENCE_MAX_LATENCY = 0.005 # seconds the first queued observation waits for the batch to fill
 
 '''FILE DIRECTORIES AND SAVE FREQUENCIES'''
 now = datetime.now()
@@ -16,6 +28,7 @@ gifs_path = f'gifs/{FOLDER_NAME}'
 GLOBAL_SAVE_IMG = True # False to have no image saved at all
 SAVE_IMG_GAP = 100 # episode interval for gif saving
 SAVE_FREQ = 32 # How often we save model in number of episodes
+KEEP_CHECKPOINTS = 3 # newest checkpoint files kept in model_path, the file 'latest' names the newest
 
 '''REWARD PARAMETERS'''
 FINISHING_REWARD = 1 # this is not scaled
@@ -30,12 +43,18 @@ NUM_PLANNING_STEP = 24
 NUM_ACTION_STEP = 5
 K_SIZE = 12  # the number of neighboring nodes
 MAP_DOWNSIZE_FACTOR = 2
+FRAGMENT_LENGTH = 0 # planning steps runners return per job with a bootstrapped tail, 0 returns whole episodes
 
 '''ENV PARAMETERS'''
 UNIFORM_POINT_INTERVAL = 50
 
 '''DRIVER PARAMETERS'''
 INPUT_DIM = (8,240,320)
+OBS_DOWNSCALING = 1 # 2 emits observations pre-pooled to 8x120x160 for a Global_Policy without its first pooling layer
+OBS_DIM = (INPUT_DIM[0], INPUT_DIM[1] // OBS_DOWNSCALING, INPUT_DIM[2] // OBS_DOWNSCALING) # shape emitted by the workers
+OBS_STORAGE = 'bitpack' # 'float', 'uint8' or 'bitpack', layout of observations kept in episode and replay buffers
+WEIGHT_TRANSFER = 'full' # 'full', 'fp16' or 'delta' (fp16 difference to a full precision keyframe)
+WEIGHT_KEYFRAME_INTERVAL = 20 # model versions between keyframes for 'delta' weight transfer
 
 '''NETWORK PARAMETERS'''
 HIDDEN_SIZE = 256
@@ -47,6 +66,16 @@ BATCH_SIZE = 128
 N_UPDATES_PER_ITERATIONS = 5 # Number of times to update actor/critic per iteration
 MINIMUM_BUFFER_SIZE = 500 # 500 for laptop 2000 for desktop
 REPLAY_SIZE = 2500 # 2500 for laptop 5000 for desktop
+REPLAY_STORAGE = 'memory' # 'memory', or 'disk' to keep replay observations in a memory-mapped file so REPLAY_SIZE can exceed RAM
+REPLAY_DISK_PATH = f'replay/{FOLDER_NAME}.obs' # file backing the replay observations with 'disk' storage, on a local disk
+ASYNC_LEARNER = False # runners stream episodes into a bounded queue while the learner trains in its own loop
+EXPERIENCE_QUEUE_SIZE = 2 * NUM_META_AGENT * ENVS_PER_RUNNER # finished episodes waiting for ingestion before dispatch pauses (async)
+MAX_POLICY_LAG = 4 * NUM_META_AGENT * ENVS_PER_RUNNER # episodes whose policy was published more than this many ingested jobs ago are dropped (async)
+MAX_UPDATES_PER_SAMPLE = 1 / NUM_PLANNING_STEP # learner updates per newly ingested sample, the learner waits for new data beyond this (async)
+PUBLISH_INTERVAL = 4 # learner updates between weight publications (async)
+PREFETCH_BATCHES = 2 # minibatches prepared ahead on a background thread, 0 to sample on the training thread
+LEARNER_PROCESSES = 1 # >1 shards every minibatch over this many CPU learner processes that all-reduce gradients over gloo
+LEARNER_PORT = 29500 # localhost port the data-parallel learner processes rendezvous on
 
 '''PPO HYPERPARAMETERS'''
 LR = 1e-5 # Learning rate of actor optimizer
@@ -54,4 +83,14 @@ GAMMA = 0.99 # Discount factor to be applied when calculating Rewards-To-Go
 CLIP = 0.2 # Recommended 0.2, helps define the threshold to clip the ratio during SGA
 MAX_GRAD_NORM = 20
 CRITIC_LOSS_COEF = 0.5
-ENTROPY_COEF = 0.0001
\ No newline at end of file
+ENTROPY_COEF = 0.0001
+
+'''PROFILING PARAMETERS'''
+STAGE_TIMING = False # time rollout and learner stages, written to tensorboard and printed every SUMMARY_WINDOW updates
+TRACE_EVERY_N_EPISODES = 0 # record every n-th episode to train_path/traces for episode_trace.py replays. 0 to disable
+PROFILE_EVERY_N_EPISODES = 0 # cProfile every n-th job on its runner, pstats files go to train_path/profiles. 0 to disable
+
+'''MEMORY PARAMETERS'''
+MEMORY_BUDGET = 0 # bytes of resident memory for the driver and all runners together, over budget the replay is trimmed, then dispatch throttled. 0 for no limit
+REPLAY_MEMORY_BUDGET = 0 # bytes of RAM for the replay buffer, caps REPLAY_SIZE. 0 for no limit
+MEMORY_CHECK_INTERVAL = 5 # seconds between memory budget checks
@@ -0,0 +1,227 @@
+import queue
+import threading
+
+import backend
+
+from memory import nested_nbytes
+from observation import expand_observations
+from timing import stage_timers
+from parameter import *
+
+
+class BatchPrefetcher:
+    # Prepares the next training minibatches on a background thread while the current update runs
+    # With expand=False observations are left in the storage layout, e.g. for the data-parallel learner
+    def __init__(self, replay_buffer, batch_size, device, num_batches=PREFETCH_BATCHES, expand=True):
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.device = device
+        self.expand = expand
+        self.pin_memory = device.type == 'cuda'
+
+        self.batches = queue.Queue(maxsize=max(num_batches, 1))
+        self.stopped = threading.Event()
+        self.error = None
+        self.thread = None
+        if num_batches > 0:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def prepare(self):
+        rollouts = self.replay_buffer.sample(self.batch_size)
+        if self.pin_memory:
+            rollouts = [data.pin_memory() for data in rollouts]
+        rollouts = [data.to(self.device, non_blocking=self.pin_memory) for data in rollouts]
+        if self.expand:
+            rollouts[0] = expand_observations(rollouts[0], self.replay_buffer.storage)
+        return rollouts
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                batch = self.prepare()
+                while not self.stopped.is_set():
+                    try:
+                        self.batches.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            self.error = e
+
+    def get(self):
+        # without a background thread the batch is prepared on the caller's thread
+        if self.thread is None:
+            return self.prepare()
+        # an error of the background thread is raised here instead of waiting for a batch forever
+        while True:
+            try:
+                return self.batches.get(timeout=0.1)
+            except queue.Empty:
+                if self.error is not None:
+                    raise self.error
+
+    def stop(self):
+        self.stopped.set()
+
+
+class EpisodeIngestor:
+    # Fetches finished jobs and writes them into the replay buffer off the training thread.
+    # With max_policy_lag set, episodes whose policy version was published more than that
+    # many fetched jobs ago are dropped. Counting jobs rather than versions keeps the lag
+    # independent of how fast the learner updates. The filter starts with the first publish,
+    # until then every episode is needed to warm up the replay buffer
+    def __init__(self, replay_buffer, max_queue_size=0, max_policy_lag=None):
+        self.replay_buffer = replay_buffer
+        self.jobs = queue.Queue(maxsize=max_queue_size)
+        self.metrics = queue.Queue()
+        self.error = None
+
+        self.max_policy_lag = max_policy_lag
+        self.fetched = 0
+        self.published_at = {} # policy version -> jobs fetched when it was published
+        self.accepted = 0
+        self.dropped = 0
+        self.policy_lag = [] # lag of every accepted episode since the last drain
+
+        self.samples = 0 # rows fetched, dropped episodes included, so learner pacing does not depend on the filter
+        self.ingested = threading.Condition()
+        self.runner_memory = {} # runner id -> memory it reported with its latest job
+        self.result_bytes = 0 # size of the latest job's results
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def published(self, version):
+        # versions too old to be accepted are forgotten, their episodes count as stale
+        if self.max_policy_lag is None:
+            return
+        if not self.published_at:
+            # the versions collected during warm-up start to age with the first publish
+            self.published_at.update((old_version, self.fetched) for old_version in range(version))
+        self.published_at[version] = self.fetched
+        for old_version, fetched in list(self.published_at.items()):
+            if self.fetched - fetched > self.max_policy_lag:
+                del self.published_at[old_version]
+
+    def wait_for_samples(self, samples, timeout=None):
+        # blocks until samples rows were fetched in total
+        with self.ingested:
+            self.ingested.wait_for(lambda: self.samples >= samples or self.error is not None, timeout)
+        return self.samples >= samples
+
+    def put(self, job_id):
+        # blocks while the queue is full, which pauses dispatch until the learner catches up
+        self.jobs.put(job_id)
+
+    def run(self):
+        while True:
+            job_id = self.jobs.get()
+            if job_id is None:
+                break
+            try:
+                job_results, metrics, info = backend.get(job_id)
+                self.result_bytes = nested_nbytes(job_results)
+                self.runner_memory[info['id']] = info['memory']
+                if info.get('stage_timings'):
+                    stage_timers.merge(info['stage_timings'])
+                self.fetched += 1
+                accepted = True
+                if self.max_policy_lag is not None and self.published_at:
+                    published_at = self.published_at.get(info['policy_version'])
+                    accepted = published_at is not None and self.fetched - published_at <= self.max_policy_lag
+                    if accepted:
+                        self.policy_lag.append(self.fetched - published_at)
+                if accepted:
+                    self.replay_buffer.add_episode(*job_results)
+                    self.accepted += 1
+                    # rollout fragments only carry metrics once their episode is over
+                    if metrics:
+                        self.metrics.put(metrics)
+                else:
+                    self.dropped += 1
+                with self.ingested:
+                    self.samples += len(job_results[0])
+                    self.ingested.notify_all()
+            except Exception as e:
+                with self.ingested:
+                    self.error = e
+                    self.ingested.notify_all()
+                break
+
+    def drain_metrics(self):
+        # metrics of every episode ingested since the last call
+        if self.error is not None:
+            raise self.error
+        metrics = []
+        while True:
+            try:
+                metrics.append(self.metrics.get_nowait())
+            except queue.Empty:
+                return metrics
+
+    def stop(self):
+        self.jobs.put(None)
+
+
+class JobCollector:
+    # Keeps one job running on every environment of every runner, re-dispatching with the latest
+    # weights packet as soon as a job finishes and handing the finished job to the ingestor.
+    # Throttled to max_in_flight jobs, the environments over the limit wait in idle
+    def __init__(self, meta_agents, ingestor, weights_packet, curr_episode, envs_per_runner=ENVS_PER_RUNNER):
+        self.meta_agents = meta_agents
+        self.ingestor = ingestor
+        self.weights_packet = weights_packet # replaced by the learner after every update
+        self.curr_episode = curr_episode
+
+        self.job_list = []
+        self.job_owner = {} # job id -> (index of the runner executing it, environment id)
+        for env_id in range(envs_per_runner):
+            for i in range(len(meta_agents)):
+                self.dispatch((i, env_id))
+        self.num_slots = len(self.job_list)
+        self.max_in_flight = self.num_slots
+        self.idle = []
+
+        self.stopped = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def dispatch(self, owner):
+        meta_agent_id, env_id = owner
+        self.curr_episode += 1
+        job_id = self.meta_agents[meta_agent_id].job.remote(self.weights_packet, self.curr_episode, env_id)
+        self.job_list.append(job_id)
+        self.job_owner[job_id] = owner
+
+    def collect(self, timeout=None):
+        done_id, self.job_list = backend.wait(self.job_list, timeout=timeout)
+        for job_id in done_id:
+            self.ingestor.put(job_id)
+            self.idle.append(self.job_owner.pop(job_id))
+        while self.idle and len(self.job_list) < self.max_in_flight:
+            self.dispatch(self.idle.pop(0))
+        return len(done_id)
+
+    def set_max_in_flight(self, max_in_flight):
+        # at least one job keeps running, idle environments are dispatched by the next collect
+        self.max_in_flight = min(max(max_in_flight, 1), self.num_slots)
+
+    def start(self):
+        # collect on a background thread so simulation overlaps with training
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                self.collect(timeout=0.5)
+        except Exception as e:
+            self.error = e
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,74 @@
+import argparse
+
+import numpy as np
+import torch
+
+from network import FixedNormal, RL_Policy
+from observation import expand_observations
+from worker import Worker
+from parameter import *
+
+
+'''
+Measures how far the int8 rollout policy (QUANTIZE_ROLLOUT) drifts from the fp32
+learner policy. Observations are recorded by running training episodes with the
+fp32 policy, actions are sampled from the fp32 policy and both policies score
+them. PPO divides the learner's log-prob by the one stored at rollout time, so
+|log pi_int8 - log pi_fp32| well below CLIP keeps the clipped ratio meaningful.
+
+    python quantization_drift.py --checkpoint model/<run>/checkpoint.pth --episodes 4
+'''
+
+
+def record_observations(actor_critic, num_episodes, first_episode):
+    observations = []
+    for i in range(num_episodes):
+        worker = Worker(0, actor_critic, first_episode + i)
+        worker.run_episode(first_episode + i)
+        observations.append(worker.get_episode_arrays()[0])
+    return torch.from_numpy(np.concatenate(observations))
+
+
+def log_prob_drift(fp32_policy, int8_policy, stored_observations, batch_size=64):
+    drift = []
+    for start in range(0, len(stored_observations), batch_size):
+        batch_obs = expand_observations(stored_observations[start:start + batch_size])
+        with torch.no_grad():
+            _, actor_features = fp32_policy(batch_obs)
+            dist = fp32_policy.dist(actor_features)
+            actions = dist.sample()
+            fp32_log_probs = dist.log_probs(actions)
+
+        _, int8_mean = int8_policy.rollout_mean(batch_obs)
+        int8_log_probs = FixedNormal(int8_mean, int8_policy.rollout_logstd.exp()).log_probs(actions)
+        drift.append(int8_log_probs - fp32_log_probs)
+    return torch.cat(drift)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='action log-prob drift of the int8 rollout policy')
+    parser.add_argument('--checkpoint', default=None, help='checkpoint.pth saved by driver.py, random weights if omitted')
+    parser.add_argument('--episodes', type=int, default=2, help='episodes recorded with the fp32 policy')
+    parser.add_argument('--first-episode', type=int, default=0, help='map index of the first recorded episode')
+    args = parser.parse_args()
+
+    fp32_policy = RL_Policy(INPUT_DIM, 2, downscaling=OBS_DOWNSCALING)
+    if args.checkpoint is not None:
+        checkpoint = torch.load(args.checkpoint, map_location=torch.device('cpu'))
+        fp32_policy.load_state_dict(checkpoint['policy_model'])
+    int8_policy = RL_Policy(INPUT_DIM, 2, downscaling=OBS_DOWNSCALING, quantize=True)
+    int8_policy.load_state_dict(fp32_policy.state_dict())
+
+    stored_observations = record_observations(fp32_policy, args.episodes, args.first_episode)
+    drift = log_prob_drift(fp32_policy, int8_policy, stored_observations)
+    ratio = drift.exp()
+
+    print('|#Observations:', len(drift))
+    print('|#Mean |log-prob drift|:', drift.abs().mean().item())
+    print('|#Max |log-prob drift|:', drift.abs().max().item())
+    print('|#Mean log-prob drift:', drift.mean().item())
+    print('|#Ratios outside 1 +- CLIP:', (ratio.sub(1).abs() > CLIP).float().mean().item())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import os
+import queue
+import threading
+
+import imageio
+import numpy as np
+
+
+'''
+Episode frames drawn straight into RGB arrays and encoded to a GIF on a
+background thread, so recording an episode costs the rollout only the array
+compositing. Env.render_frame uses these helpers.
+'''
+
+BELIEF_COLOURS = {1: (0, 0, 0), 127: (127, 127, 127), 255: (255, 255, 255)} # occupied, unknown, free
+
+
+def belief_image(robot_belief):
+    image = np.empty((*robot_belief.shape, 3), dtype=np.uint8)
+    image[...] = BELIEF_COLOURS[127]
+    for value, colour in BELIEF_COLOURS.items():
+        image[robot_belief == value] = colour
+    return image
+
+
+def draw_points(image, points, colour, radius=0):
+    # points are (x, y) pixel coordinates, each drawn as a square of side 2 * radius + 1
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    height, width = image.shape[:2]
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            x, y = points[:, 0] + dx, points[:, 1] + dy
+            inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            image[y[inside], x[inside]] = colour
+
+
+def line_points(path, dash=0):
+    # pixels along a polyline of (x, y) points, with dash > 0 every other run of dash pixels is skipped
+    path = np.asarray(path, dtype=np.float64).reshape(-1, 2)
+    segments = []
+    for start, end in zip(path[:-1], path[1:]):
+        num = int(np.abs(end - start).max()) + 1
+        segments.append(np.linspace(start, end, num))
+    if not segments:
+        return path.astype(np.int64)
+    points = np.round(np.concatenate(segments)).astype(np.int64)
+    if dash > 0:
+        points = points[(np.arange(len(points)) // dash) % 2 == 0]
+    return points
+
+
+def draw_disk(image, centre, colour, radius):
+    offsets = np.array([(dx, dy) for dx in range(-radius, radius + 1) for dy in range(-radius, radius + 1)
+                        if dx * dx + dy * dy <= radius * radius])
+    draw_points(image, offsets + np.asarray(centre, dtype=np.int64), colour)
+
+
+def draw_cross(image, centre, colour, size):
+    x, y = centre
+    draw_points(image, line_points([(x - size, y - size), (x + size, y + size)]), colour, radius=1)
+    draw_points(image, line_points([(x - size, y + size), (x + size, y - size)]), colour, radius=1)
+
+
+def draw_progress(image, fraction, colour, height=6):
+    # bar across the top of the frame, e.g. the explored rate
+    image[:height] = (255, 255, 255)
+    image[:height, :int(round(fraction * image.shape[1]))] = colour
+
+
+class GifEncoder:
+    # Streams frames into a GIF on a background thread. The file is written under a temporary
+    # name and renamed when the episode closes it, so a partial GIF never has the final name.
+    # At most max_frames frames wait for the encoder, the rollout blocks when it falls behind
+    def __init__(self, path, duration=0.5, max_frames=16):
+        self.temp_path = path + '.part'
+        self.frames = queue.Queue(maxsize=max_frames)
+        self.error = None
+        # not a daemon, a process that exits right after an episode still finishes its GIF
+        self.thread = threading.Thread(target=self.run, args=(duration,))
+        self.thread.start()
+
+    def put(self, item):
+        # nothing is queued once the encoder stopped, a full queue would never drain
+        while self.thread.is_alive():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def add(self, frame):
+        # an encoder that failed stops the episode rather than frames piling up
+        if self.error is not None:
+            raise self.error
+        self.put(frame)
+
+    def close(self, path, last_frame_path=None):
+        # returns at once, the encoder renames the GIF to path when every frame is written
+        if self.error is not None:
+            raise self.error
+        self.put((path, last_frame_path))
+
+    def abort(self):
+        # for an episode that failed, the thread stops and the partial GIF is removed
+        self.put(None)
+
+    def run(self, duration):
+        last_frame = None
+        try:
+            with imageio.get_writer(self.temp_path, format='GIF', mode='I', duration=duration) as writer:
+                while True:
+                    frame = self.frames.get()
+                    if frame is None or isinstance(frame, tuple):
+                        break
+                    writer.append_data(frame)
+                    last_frame = frame
+        except Exception as e:
+            self.error = e
+            frame = None
+        if frame is None:
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+            return
+        path, last_frame_path = frame
+        os.replace(self.temp_path, path)
+        # the final state is also kept as a still image
+        if last_frame_path is not None and last_frame is not None:
+            imageio.imwrite(last_frame_path, last_frame)
+        print('gif complete\n')
@@ -0,0 +1,165 @@
+import mmap
+import os
+import threading
+
+import numpy as np
+import torch
+
+from observation import storage_dtype, storage_shape
+from parameter import *
+
+
+def map_memory(shape, dtype, path=None):
+    # tensor on a private anonymous memory map, or on a new file at path, and the map itself.
+    # Unlike torch.zeros, the pages of rows dropped by ReplayBuffer.resize can be handed back
+    count = int(np.prod(shape))
+    numpy_dtype = torch.zeros(0, dtype=dtype).numpy().dtype
+    nbytes = max(count * numpy_dtype.itemsize, 1)
+    if path is not None:
+        with open(path, 'w+b') as f:
+            f.truncate(nbytes)
+            mapping = mmap.mmap(f.fileno(), nbytes)
+    elif hasattr(mmap, 'MAP_PRIVATE'):
+        mapping = mmap.mmap(-1, nbytes, flags=mmap.MAP_PRIVATE)
+    else:
+        mapping = mmap.mmap(-1, nbytes)
+    array = np.frombuffer(mapping, dtype=numpy_dtype, count=count).reshape(shape)
+    return torch.from_numpy(array), mapping
+
+
+def release_pages(mapping, nbytes):
+    # everything past the first nbytes of the map goes back to the OS
+    start = -(-nbytes // mmap.PAGESIZE) * mmap.PAGESIZE
+    if start < len(mapping) and hasattr(mapping, 'madvise'):
+        mapping.madvise(mmap.MADV_DONTNEED, start, len(mapping) - start)
+
+
+def move_rows(buffer, source, destination, count, chunk=256):
+    # destination <= source, chunks are moved front to back so no row is overwritten before it moved
+    if source == destination:
+        return
+    for start in range(0, count, chunk):
+        rows = buffer[source + start:source + min(start + chunk, count)].clone()
+        buffer[destination + start:destination + start + len(rows)] = rows
+
+
+class ReplayBuffer:
+    # Ring buffer of preallocated contiguous tensors, one row per planning step. With
+    # location='disk' the observations are fixed-size records in a memory-mapped file and only
+    # the scalar fields stay in RAM, minibatch gathers read the records through the page cache
+    def __init__(self, capacity, obs_shape, action_dim, storage=OBS_STORAGE, location=REPLAY_STORAGE, path=REPLAY_DISK_PATH,
+                 memory_budget=REPLAY_MEMORY_BUDGET, min_capacity=MINIMUM_BUFFER_SIZE):
+        assert location in ('memory', 'disk')
+        self.storage = storage
+        self.path = path if location == 'disk' else None
+
+        obs_shape = storage_shape(obs_shape, storage)
+        obs_dtype = storage_dtype(storage)
+        if memory_budget > 0:
+            # bytes of RAM per row, the mapped observations do not count
+            row_bytes = 4 * (action_dim + 3)
+            if self.path is None:
+                row_bytes += torch.zeros(obs_shape, dtype=obs_dtype).nbytes
+            capacity = min(capacity, memory_budget // row_bytes)
+            # training starts once min_capacity rows are stored, a smaller buffer would never get there
+            assert capacity >= min_capacity, "REPLAY_MEMORY_BUDGET fits {} rows, training needs {}".format(capacity, min_capacity)
+        self.capacity = capacity
+
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fields = [map_memory((capacity, *obs_shape), obs_dtype, self.path),
+                  map_memory((capacity, action_dim), torch.float),
+                  map_memory((capacity,), torch.float),
+                  map_memory((capacity,), torch.float),
+                  map_memory((capacity,), torch.float)]
+        self.observations, self.actions, self.log_probs, self.rewards, self.returns = [tensor for tensor, _ in fields]
+        self.mappings = [mapping for _, mapping in fields]
+
+        self.size = 0
+        self.next_index = 0 # row the next sample is written to
+        self.lock = threading.Lock() # episodes may be added while a batch is sampled
+
+        # numpy views sharing memory with the tensors, episodes arrive as arrays from the runners
+        self.arrays = [buffer.numpy() for buffer in self.buffers()]
+
+    def __len__(self):
+        return self.size
+
+    def buffers(self):
+        return [self.observations, self.actions, self.log_probs, self.rewards, self.returns]
+
+    @property
+    def nbytes(self):
+        return sum(buffer.element_size() * buffer.nelement() for buffer in self.buffers())
+
+    @property
+    def disk_nbytes(self):
+        # bytes of the memory-mapped observations, not held in RAM
+        if self.path is None:
+            return 0
+        return self.observations.element_size() * self.observations.nelement()
+
+    def close(self):
+        # the mapped file is scratch space and removed with the buffer
+        if self.path is not None and os.path.exists(self.path):
+            self.arrays[0] = None
+            self.observations = None
+            os.remove(self.path)
+
+    def resize(self, capacity):
+        # shrinks to the newest capacity rows. They are compacted in place, so no second copy of the
+        # buffer is allocated while memory is short, and the pages past them go back to the OS
+        assert capacity <= self.capacity
+        with self.lock:
+            if self.size > capacity:
+                # the rows before next_index are the newest. Either they fill the smaller ring alone,
+                # or the newest rows at the end of the full ring move up behind them
+                if self.next_index >= capacity:
+                    source, destination, count = self.next_index - capacity, 0, capacity
+                else:
+                    count = capacity - self.next_index
+                    source, destination = self.capacity - count, self.next_index
+                for buffer in self.buffers():
+                    move_rows(buffer, source, destination, count)
+                self.next_index = destination % capacity
+                self.size = capacity
+            else:
+                # a ring that is not full holds its rows from index 0
+                self.next_index = self.size % capacity
+
+            buffers = [buffer[:capacity] for buffer in self.buffers()]
+            for buffer, mapping in zip(buffers, self.mappings):
+                release_pages(mapping, buffer.element_size() * buffer.nelement())
+            if self.path is not None:
+                os.truncate(self.path, max(buffers[0].element_size() * buffers[0].nelement(), 1))
+
+            self.observations, self.actions, self.log_probs, self.rewards, self.returns = buffers
+            self.arrays = [buffer.numpy() for buffer in buffers]
+            self.capacity = capacity
+
+    def add_episode(self, observations, actions, log_probs, rewards, returns):
+        # each field is a numpy array with one row per planning step
+        episode = [observations, actions, log_probs, rewards, returns]
+        length = len(observations)
+
+        # an episode longer than the buffer only keeps its latest samples
+        if length > self.capacity:
+            episode = [data[-self.capacity:] for data in episode]
+            length = self.capacity
+
+        with self.lock:
+            # at most two contiguous copies per field, the second one wraps around
+            first = min(length, self.capacity - self.next_index)
+            for array, data in zip(self.arrays, episode):
+                data = np.asarray(data)
+                array[self.next_index:self.next_index + first] = data[:first]
+                array[:length - first] = data[first:]
+
+            self.next_index = (self.next_index + length) % self.capacity
+            self.size = min(self.size + length, self.capacity)
+
+    def sample(self, batch_size):
+        # sample without replacement, then gather every field with one index tensor
+        with self.lock:
+            indices = torch.randperm(self.size)[:batch_size]
+            return [buffer.index_select(0, indices) for buffer in self.buffers()]
@@ -0,0 +1,55 @@
+import os
+
+import torch
+
+from parameter import *
+
+
+# thread pools read these when the libraries are first loaded
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def cpu_assignment(role, index=0):
+    # runners take RUNNER_NUM_THREADS consecutive cores each, the learner processes split the cores after them
+    cpus = available_cpus()
+    runner_cpus = NUM_META_AGENT * RUNNER_NUM_THREADS
+    if role == 'learner':
+        learner_cpus = LEARNER_NUM_THREADS or max(1, len(cpus) - runner_cpus)
+        num_threads = max(1, learner_cpus // LEARNER_PROCESSES)
+        first = runner_cpus + index * num_threads
+    else:
+        num_threads = RUNNER_NUM_THREADS
+        first = index * RUNNER_NUM_THREADS
+    return num_threads, [cpus[(first + i) % len(cpus)] for i in range(num_threads)]
+
+
+def thread_env_vars(role, index=0):
+    # environment for a process that has not loaded numpy or torch yet
+    num_threads, _ = cpu_assignment(role, index)
+    return {var: str(num_threads) for var in THREAD_ENV_VARS}
+
+
+def configure_threads(role, index=0):
+    num_threads, cpus = cpu_assignment(role, index)
+    os.environ.update({var: str(num_threads) for var in THREAD_ENV_VARS})
+    torch.set_num_threads(num_threads)
+
+    # BLAS pools that are already running can only be resized through threadpoolctl
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(num_threads)
+    except ImportError:
+        pass
+
+    if PIN_CPU_AFFINITY and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+    affinity = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else 'any'
+    print("{} {}: {} torch threads, cpus {}".format(role, index, torch.get_num_threads(), affinity))
@@ -0,0 +1,135 @@
+import argparse
+import json
+import platform
+import time
+
+import numpy as np
+import torch
+
+import backend
+from network import RL_Policy
+from resources import available_cpus, thread_env_vars
+from runner import Runner
+from weights import WeightPublisher
+from parameter import *
+
+
+'''
+End-to-end rollout throughput without learning. Starts runners, drives them with
+one fixed RL_Policy (random init or a checkpoint) and measures episodes/s,
+planning steps/s and env steps/s, the bytes of experience returned through the
+backend and each runner's CPU utilisation. Sweeps runner and environment counts
+and writes a JSON report to chart against core count:
+
+    python rollout_benchmark.py --runners 1 2 4 8 --envs 1 2 --duration 120 --output rollout.json
+'''
+
+
+def episode_numbers(first):
+    # episodes are only numbered, never trained on. Multiples of SAVE_IMG_GAP are skipped so no gifs are rendered
+    number = first
+    while True:
+        number += 1
+        if number % SAVE_IMG_GAP != 0:
+            yield number
+
+
+def run_config(num_runners, envs_per_runner, weights_packet, duration, warmup):
+    # the GPUs are split over the runners of this configuration, a sweep past NUM_META_AGENT still fits
+    meta_agents = [backend.create_actor(Runner, i, None, max_concurrency=envs_per_runner + 1,
+                                        env_vars=thread_env_vars('runner', i),
+                                        num_cpus=RUNNER_NUM_THREADS, num_gpus=NUM_GPU / num_runners if USE_GPU else 0)
+                   for i in range(num_runners)]
+    numbers = episode_numbers(0)
+    job_owner = {}
+    for env_id in range(envs_per_runner):
+        for i, meta_agent in enumerate(meta_agents):
+            job_owner[meta_agent.job.remote(weights_packet, next(numbers), env_id)] = (i, env_id)
+
+    # jobs finishing during the warmup include actor start-up and the first weight load
+    episodes = planning_steps = env_steps = result_bytes = 0
+    start = time.time()
+    measure_start = start + warmup
+    cpu_start = None
+    while time.time() < measure_start + duration:
+        done_id, _ = backend.wait(list(job_owner), timeout=1.0)
+        if cpu_start is None and time.time() >= measure_start:
+            measure_start = time.time()
+            cpu_start = backend.get([meta_agent.get_cpu_time.remote() for meta_agent in meta_agents])
+        for job_id in done_id:
+            i, env_id = job_owner.pop(job_id)
+            job_results, metrics, info = backend.get(job_id)
+            if cpu_start is not None:
+                episodes += 1 if metrics else 0
+                planning_steps += len(job_results[0])
+                env_steps += info['env_steps']
+                result_bytes += sum(np.asarray(data).nbytes for data in job_results)
+            job_owner[meta_agents[i].job.remote(weights_packet, next(numbers), env_id)] = (i, env_id)
+    elapsed = time.time() - measure_start
+    cpu_end = backend.get([meta_agent.get_cpu_time.remote() for meta_agent in meta_agents])
+
+    for meta_agent in meta_agents:
+        backend.kill(meta_agent)
+
+    return {'num_runners': num_runners,
+            'envs_per_runner': envs_per_runner,
+            'duration_s': elapsed,
+            'episodes': episodes,
+            'planning_steps': planning_steps,
+            'env_steps': env_steps,
+            'episodes_per_s': episodes / elapsed,
+            'planning_steps_per_s': planning_steps / elapsed,
+            'env_steps_per_s': env_steps / elapsed,
+            'result_bytes': result_bytes,
+            'result_bytes_per_s': result_bytes / elapsed,
+            'runner_cpu_utilisation': [(end - begin) / elapsed for begin, end in zip(cpu_start, cpu_end)]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='rollout throughput benchmark without learner updates')
+    parser.add_argument('--runners', type=int, nargs='+', default=[NUM_META_AGENT], help='runner counts to sweep')
+    parser.add_argument('--envs', type=int, nargs='+', default=[ENVS_PER_RUNNER], help='environments per runner to sweep')
+    parser.add_argument('--duration', type=float, default=60, help='measured seconds per configuration')
+    parser.add_argument('--warmup', type=float, default=10, help='seconds ignored at the start of each configuration')
+    parser.add_argument('--checkpoint', default=None, help='checkpoint.pth saved by driver.py, random weights if omitted')
+    parser.add_argument('--output', default=None, help='write the report as JSON')
+    args = parser.parse_args()
+
+    backend.init(EXECUTION_BACKEND)
+
+    actor_critic = RL_Policy(INPUT_DIM, 2, downscaling=OBS_DOWNSCALING)
+    if args.checkpoint is not None:
+        checkpoint = torch.load(args.checkpoint, map_location=torch.device('cpu'))
+        actor_critic.load_state_dict(checkpoint['policy_model'])
+    weights = actor_critic.state_dict()
+    weights_packet = WeightPublisher().publish(weights)
+    weight_bytes = sum(tensor.element_size() * tensor.nelement() for tensor in weights.values())
+
+    report = {'host': {'platform': platform.platform(), 'cpus': len(available_cpus())},
+              'backend': EXECUTION_BACKEND,
+              'policy': args.checkpoint or 'random',
+              'settings': {'fast_inference': FAST_INFERENCE, 'quantize_rollout': QUANTIZE_ROLLOUT,
+                           'fragment_length': FRAGMENT_LENGTH, 'obs_storage': OBS_STORAGE,
+                           'runner_num_threads': RUNNER_NUM_THREADS},
+              'weight_bytes': weight_bytes,
+              'runs': []}
+
+    for num_runners in args.runners:
+        for envs_per_runner in args.envs:
+            result = run_config(num_runners, envs_per_runner, weights_packet, args.duration, args.warmup)
+            # every runner fetches the weights once
+            result['weight_bytes'] = weight_bytes * num_runners
+            report['runs'].append(result)
+            print('runners {:>3} envs {:>2} | {:7.3f} episodes/s {:8.2f} planning steps/s {:8.2f} env steps/s '
+                  '| {:8.1f} KB/s results | cpu {}'.format(
+                      num_runners, envs_per_runner, result['episodes_per_s'], result['planning_steps_per_s'],
+                      result['env_steps_per_s'], result['result_bytes_per_s'] / 1024,
+                      ' '.join('{:.0%}'.format(u) for u in result['runner_cpu_utilisation'])))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
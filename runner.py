@@ -1,52 +1,176 @@
+import cProfile
+import os
+import threading
+import time
+
 import torch
 import ray
+from inference_server import RemotePolicy
+from memory import module_nbytes, nested_nbytes, resident_bytes
 from network import RL_Policy
+from resources import configure_threads
+from timing import stage_timers
+from weights import WeightReceiver
 from worker import Worker
 from parameter import *
 
 
+class SharedPolicy(object):
+    # One policy used by all environments of a runner, local act and weight loading never overlap
+    def __init__(self, actor_critic, weight_receiver, lock):
+        self.actor_critic = actor_critic
+        self.weight_receiver = weight_receiver
+        self.lock = lock
+
+    def act_with_version(self, observations):
+        # no local model behind a remote policy, requests of all environments reach the
+        # inference server concurrently so its batches can fill
+        if isinstance(self.actor_critic, RemotePolicy):
+            return self.actor_critic.act_with_version(observations)
+        with self.lock:
+            return (*self.actor_critic.act(observations), self.weight_receiver.version)
+
+
+class EpisodePolicy(object):
+    # A Worker's view of the shared policy. Other environments' jobs may load newer weights
+    # during an episode, so every action records the version that chose it
+    def __init__(self, policy):
+        self.policy = policy
+        self.last_version = None
+        self.oldest_version = None # of the actions in the current job
+
+    def act(self, observations):
+        value, action, action_log_probs, version = self.policy.act_with_version(observations)
+        self.last_version = version
+        if self.oldest_version is None or version < self.oldest_version:
+            self.oldest_version = version
+        return value, action, action_log_probs
+
+    def start_job(self):
+        # a fragment starts with the decision taken at the end of the previous one
+        self.oldest_version = self.last_version
+
+
 class Runner(object):
-    def __init__(self, meta_agent_id):
+    def __init__(self, meta_agent_id, inference_server=None):
         self.meta_agent_id = meta_agent_id
+        configure_threads('runner', meta_agent_id)
         self.local_device = torch.device('cuda') if USE_GPU else torch.device('cpu')
-        # Initialise local actor critic for simulation
-        self.actor_critic = RL_Policy(INPUT_DIM, 2).to(self.local_device)
+        self.weight_receiver = WeightReceiver()
+        # Initialise local actor critic for simulation, or only simulate and
+        # let the shared inference server act
+        if inference_server is None:
+            self.actor_critic = RL_Policy(INPUT_DIM, 2, downscaling=OBS_DOWNSCALING, fast_inference=FAST_INFERENCE,
+                                          quantize=QUANTIZE_ROLLOUT).to(self.local_device)
+        else:
+            self.actor_critic = RemotePolicy(inference_server)
+
+        # up to ENVS_PER_RUNNER jobs run concurrently on the actor's threads, one per environment
+        self.policy_lock = threading.Lock()
+        self.policy = SharedPolicy(self.actor_critic, self.weight_receiver, self.policy_lock)
+        self.workers = {} # env id -> episode in progress when returning rollout fragments
 
     def get_weights(self):
         return self.actor_critic.state_dict()
 
-    def set_actor_critic_weights(self, weights):
-        self.actor_critic.load_state_dict(weights)
+    def set_actor_critic_weights(self, weights_packet):
+        # the inference server receives its weights from the driver directly
+        if isinstance(self.actor_critic, RemotePolicy):
+            return
+        # only fetches and loads the weights if this version is not loaded yet
+        with self.policy_lock:
+            self.weight_receiver.load(self.actor_critic, weights_packet)
+
+    def get_cpu_time(self):
+        # cpu seconds used by all threads of this runner process
+        return time.process_time()
+
+    def memory_usage(self, job_results, env_id):
+        # the episode or fragment just finished, plus the episodes other environments continue in later
+        # fragments. Their jobs add and remove workers concurrently
+        others = [worker for worker_env_id, worker in list(self.workers.items()) if worker_env_id != env_id]
+        return {'rss': resident_bytes(),
+                'model': module_nbytes(self.actor_critic),
+                'episode_buffers': nested_nbytes(job_results) + sum(nested_nbytes(worker.episode_buffer) for worker in others)}
 
     def do_job(self, curr_episode):
         save_img = True and GLOBAL_SAVE_IMG if curr_episode % SAVE_IMG_GAP == 0 else False
-        worker = Worker(self.meta_agent_id, self.actor_critic, curr_episode, save_image=save_img)
+        policy = EpisodePolicy(self.policy)
+        worker = Worker(self.meta_agent_id, policy, curr_episode, save_image=save_img)
         worker.work(curr_episode)
 
-        job_results = worker.episode_buffer
+        job_results = worker.get_episode_arrays()
         perf_metrics = worker.perf_metrics
 
-        return job_results, perf_metrics
+        return job_results, perf_metrics, worker.num_step, policy.oldest_version
+
+    def do_fragment(self, curr_episode, env_id=0):
+        # continue the episode in progress on this environment, or start a new one for this job number
+        worker = self.workers.get(env_id)
+        if worker is None:
+            save_img = True and GLOBAL_SAVE_IMG if curr_episode % SAVE_IMG_GAP == 0 else False
+            worker = Worker(self.meta_agent_id, EpisodePolicy(self.policy), curr_episode, save_image=save_img)
+            worker.begin_episode()
+            self.workers[env_id] = worker
+        num_step = worker.num_step
+        worker.actor_critic.start_job()
+        worker.run_fragment(FRAGMENT_LENGTH)
+
+        job_results = worker.get_episode_arrays()
+        perf_metrics = worker.perf_metrics # empty until the episode is over
+        if worker.episode_over:
+            del self.workers[env_id]
 
-    def job(self, weights, episode_number):
-        print("starting episode {} on metaAgent {}".format(episode_number, self.meta_agent_id))
+        return job_results, perf_metrics, worker.num_step - num_step, worker.actor_critic.oldest_version
+
+    def job(self, weights_packet, episode_number, env_id=0, profile=False):
+        print("starting episode {} on metaAgent {} env {}".format(episode_number, self.meta_agent_id, env_id))
         # set the local weights to the global weight values from the master network
-        self.set_actor_critic_weights(weights)
+        self.set_actor_critic_weights(weights_packet)
+
+        # only this job's thread is profiled, other jobs and runners are unaffected
+        profile = profile or (PROFILE_EVERY_N_EPISODES > 0 and episode_number % PROFILE_EVERY_N_EPISODES == 0)
+        profiler = cProfile.Profile() if profile else None
+        if profiler is not None:
+            profiler.enable()
 
-        job_results, metrics = self.do_job(episode_number)
+        if FRAGMENT_LENGTH > 0:
+            job_results, metrics, env_steps, policy_version = self.do_fragment(episode_number, env_id)
+        else:
+            job_results, metrics, env_steps, policy_version = self.do_job(episode_number)
+
+        profile_path = None
+        if profiler is not None:
+            profiler.disable()
+            profile_path = self.save_profile(profiler, episode_number, env_id)
 
         info = {
             "id": self.meta_agent_id,
+            "env_id": env_id,
             "episode_number": episode_number,
+            "policy_version": policy_version, # oldest weights that chose an action in this job
+            "env_steps": env_steps,
+            "stage_timings": stage_timers.drain() if STAGE_TIMING else {}, # every job run on this runner since the last one
+            "profile_path": profile_path,
+            "memory": self.memory_usage(job_results, env_id),
         }
 
         return job_results, metrics, info
 
+    def save_profile(self, profiler, episode_number, env_id):
+        # open with python -m pstats, snakeviz or gprof2dot
+        profile_dir = os.path.join(train_path, 'profiles')
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, 'episode_{}_agent_{}_env_{}.pstats'.format(episode_number, self.meta_agent_id, env_id))
+        profiler.dump_stats(path)
+        print("saved profile of episode {} to {}".format(episode_number, path))
+        return path
+
   
 @ray.remote(num_cpus=1, num_gpus=NUM_GPU/NUM_META_AGENT)
 class RLRunner(Runner):
-    def __init__(self, meta_agent_id):        
-        super().__init__(meta_agent_id)
+    def __init__(self, meta_agent_id, inference_server=None):
+        super().__init__(meta_agent_id, inference_server)
 
 
 if __name__=='__main__':
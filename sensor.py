@@ -1,5 +1,7 @@
 import numpy as np
 
+from timing import timed
+
 
 def collision_check(x0, y0, x1, y1, ground_truth, robot_belief):
     x0 = x0.round()
@@ -44,6 +46,7 @@ def collision_check(x0, y0, x1, y1, ground_truth, robot_belief):
     return robot_belief
 
 
+@timed('sensor_work')
 def sensor_work(robot_position, sensor_range, robot_belief, ground_truth):
     sensor_angle_inc = 0.5 / 180 * np.pi
     sensor_angle = 0
@@ -1,8 +1,9 @@
-import ray
 import numpy as np
 import os
 import torch
 
+import backend
+from checkpoint import load_latest_checkpoint
 from network import RL_Policy
 from test_worker import TestWorker
 from test_parameter import *
@@ -18,15 +19,14 @@ def run_test():
     # initialize actor critic network
     actor_critic = RL_Policy(INPUT_DIM, 2).to(device)
 
-    if device == 'cuda':
-        checkpoint = torch.load(f'{model_path}/checkpoint.pth')
-    else:
-        checkpoint = torch.load(f'{model_path}/checkpoint.pth', map_location = torch.device('cpu'))
+    # newest valid checkpoint of the run
+    _, checkpoint = load_latest_checkpoint(model_path, map_location=device)
 
     actor_critic.load_state_dict(checkpoint['policy_model'])
 
-    meta_agents = [Runner.remote(i) for i in range(NUM_META_AGENT)]
-    weights = actor_critic.state_dict()
+    meta_agents = [backend.create_actor(Runner, i, num_cpus=1, num_gpus=NUM_GPU/NUM_META_AGENT)
+                   for i in range(NUM_META_AGENT)]
+    weights = backend.put(actor_critic.state_dict())
     curr_test = 0
 
     dist_history = []
@@ -38,8 +38,8 @@ def run_test():
 
     try:
         while len(dist_history) < curr_test:
-            done_id, job_list = ray.wait(job_list)
-            done_jobs = ray.get(done_id)
+            done_id, job_list = backend.wait(job_list)
+            done_jobs = backend.get(done_id)
 
             for job in done_jobs:
                 metrics, info = job
@@ -55,10 +55,9 @@ def run_test():
     except KeyboardInterrupt:
         print("CTRL_C pressed. Killing remote workers")
         for a in meta_agents:
-            ray.kill(a)
+            backend.kill(a)
 
 
-@ray.remote(num_cpus=1, num_gpus=NUM_GPU/NUM_META_AGENT)
 class Runner(object):
     def __init__(self, meta_agent_id):
         self.meta_agent_id = meta_agent_id
@@ -94,6 +93,6 @@ class Runner(object):
 
 
 if __name__ == '__main__':
-    ray.init()
+    backend.init(EXECUTION_BACKEND)
     for i in range(NUM_RUN):
         run_test()
@@ -2,6 +2,7 @@
 USE_GPU = True  # do you want to use GPU to test
 NUM_GPU = 1
 NUM_META_AGENT = 4 # 4 for laptop 8 for desktop
+EXECUTION_BACKEND = 'ray' # 'ray', or 'local' for single node multiprocessing with shared memory and no Ray services
 
 '''FILE DIRECTORIES AND SAVE FREQUENCIES'''
 FOLDER_NAME = "run_2023_09_24_0053"
@@ -0,0 +1,115 @@
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+import numpy as np
+
+from parameter import *
+
+
+'''
+Per-stage wall time registry. With STAGE_TIMING off, timed returns the function
+unchanged and stage returns a shared no-op context, so the hooks cost nothing.
+Each process records into its own stage_timers; runners drain theirs into every
+job's info and the driver merges them with its own learner stages.
+'''
+
+# histogram bin edges in seconds, four bins per decade from 10us to 100s
+BIN_EDGES = [10 ** (exponent / 4) for exponent in range(-20, 9)]
+
+
+class StageTimers:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def new_stats(self):
+        return {'count': 0, 'total': 0., 'max': 0., 'histogram': np.zeros(len(BIN_EDGES) + 1, dtype=np.int64)}
+
+    def record(self, stage, seconds):
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = self.new_stats()
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['histogram'][bisect.bisect(BIN_EDGES, seconds)] += 1
+
+    def merge(self, stages):
+        # add stats drained by another process
+        with self.lock:
+            for stage, other in stages.items():
+                stats = self.stages.get(stage)
+                if stats is None:
+                    stats = self.stages[stage] = self.new_stats()
+                stats['count'] += other['count']
+                stats['total'] += other['total']
+                stats['max'] = max(stats['max'], other['max'])
+                stats['histogram'] += other['histogram']
+
+    def drain(self):
+        # stats recorded since the last drain
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+
+stage_timers = StageTimers()
+_no_timing = contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def _timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_timers.record(name, time.perf_counter() - start)
+
+
+def stage(name):
+    # with stage('learner/update'): ...
+    return _timed_stage(name) if STAGE_TIMING else _no_timing
+
+
+def timed(name):
+    # decorator form of stage, applied when the module is imported
+    def decorator(function):
+        if not STAGE_TIMING:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stage_timers.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def percentile(stats, q):
+    # upper bin edge of the q-th percentile, an estimate within a quarter decade
+    cumulative = np.cumsum(stats['histogram'])
+    index = int(np.searchsorted(cumulative, q / 100 * stats['count']))
+    return min(BIN_EDGES[index], stats['max']) if index < len(BIN_EDGES) else stats['max']
+
+
+def write_stage_timings(writer, stages, global_step):
+    for name, stats in stages.items():
+        writer.add_scalar(tag='Timing/{} mean ms'.format(name), scalar_value=1000 * stats['total'] / stats['count'], global_step=global_step)
+        writer.add_scalar(tag='Timing/{} p90 ms'.format(name), scalar_value=1000 * percentile(stats, 90), global_step=global_step)
+        writer.add_scalar(tag='Timing/{} total s'.format(name), scalar_value=stats['total'], global_step=global_step)
+
+
+def format_stage_timings(stages):
+    lines = ['{:<24}{:>10}{:>12}{:>12}{:>12}{:>12}'.format('stage', 'calls', 'total s', 'mean ms', 'p90 ms', 'max ms')]
+    for name, stats in sorted(stages.items(), key=lambda item: -item[1]['total']):
+        lines.append('{:<24}{:>10}{:>12.2f}{:>12.3f}{:>12.3f}{:>12.3f}'.format(
+            name, stats['count'], stats['total'], 1000 * stats['total'] / stats['count'],
+            1000 * percentile(stats, 90), 1000 * stats['max']))
+    return '\n'.join(lines)
@@ -0,0 +1,75 @@
+import backend
+
+from parameter import *
+
+
+def cpu_state_dict(state_dict):
+    return {name: tensor.detach().cpu().clone() for name, tensor in state_dict.items()}
+
+
+class WeightPublisher:
+    # Puts each model version into the object store once and hands out small packets
+    # that runners resolve only when their loaded version is out of date
+    def __init__(self, transfer=WEIGHT_TRANSFER, keyframe_interval=WEIGHT_KEYFRAME_INTERVAL):
+        assert transfer in ('full', 'fp16', 'delta')
+        self.transfer = transfer
+        self.keyframe_interval = keyframe_interval
+        self.version = -1
+        self.packet = None
+
+        # full precision base the 'delta' transfer is relative to
+        self.keyframe = None
+        self.keyframe_version = None
+        self.keyframe_id = None
+
+    def publish(self, state_dict):
+        self.version += 1
+        weights = cpu_state_dict(state_dict)
+        packet = {'version': self.version, 'transfer': self.transfer}
+
+        if self.transfer == 'full':
+            packet['weights_id'] = backend.put(weights)
+
+        elif self.transfer == 'fp16':
+            packet['weights_id'] = backend.put({name: tensor.half() if tensor.is_floating_point() else tensor
+                                            for name, tensor in weights.items()})
+
+        else:
+            if self.keyframe is None or self.version - self.keyframe_version >= self.keyframe_interval:
+                self.keyframe = weights
+                self.keyframe_version = self.version
+                self.keyframe_id = backend.put(weights)
+            # deltas are always against the fp32 keyframe so fp16 rounding does not accumulate
+            delta = {name: (tensor - self.keyframe[name]).half() if tensor.is_floating_point() else tensor
+                     for name, tensor in weights.items()}
+            packet['weights_id'] = backend.put(delta)
+            packet['keyframe_version'] = self.keyframe_version
+            packet['keyframe_id'] = self.keyframe_id
+
+        self.packet = packet
+        return packet
+
+
+class WeightReceiver:
+    # Runner side of WeightPublisher, loads a packet into a model unless that version is already loaded
+    def __init__(self):
+        self.version = None
+        self.keyframe = None
+        self.keyframe_version = None
+
+    def load(self, model, packet):
+        if packet['version'] == self.version:
+            return False
+
+        weights = backend.get(packet['weights_id'])
+        if packet['transfer'] == 'delta':
+            if packet['keyframe_version'] != self.keyframe_version:
+                self.keyframe = backend.get(packet['keyframe_id'])
+                self.keyframe_version = packet['keyframe_version']
+            weights = {name: self.keyframe[name] + tensor.float() if tensor.is_floating_point() else tensor
+                       for name, tensor in weights.items()}
+
+        # load_state_dict copies into the existing parameters, casting fp16 back to their dtype
+        model.load_state_dict(weights)
+        self.version = packet['version']
+        return True
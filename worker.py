@@ -2,17 +2,20 @@ import copy
 import os
 import matplotlib.pyplot as plt
 
-import imageio
 import numpy as np
 import torch
 import torch.nn as nn
 
 from env import Env
+from episode_trace import TraceRecorder
+from rendering import GifEncoder
+from observation import compress_observations
+from timing import stage, timed
 from parameter import *
 
 
 class Worker:
-    def __init__(self, meta_agent_id, actor_critic, global_step, save_image=False):
+    def __init__(self, meta_agent_id, actor_critic, global_step, save_image=False, map_dir=None):
         # Handle devices for global training and local simulation
         self.device = torch.device('cuda') if USE_GPU_GLOBAL else torch.device('cpu')
         self.local_device = torch.device('cuda') if USE_GPU else torch.device('cpu')
@@ -26,15 +29,38 @@ class Worker:
         self.k_size = K_SIZE
         self.max_timestep = MAX_TIMESTEP_PER_EPISODE
         self.save_image = save_image
-        self.env = Env(map_index=self.global_step, k_size=self.k_size, plot=save_image)
+        # maps from an evaluation directory end episodes with the test termination check
+        self.env = Env(map_index=self.global_step, k_size=self.k_size, plot=save_image,
+                       test=map_dir is not None, map_dir=map_dir)
+        # names the gif and trace files, concurrent evaluations of the same map index in other splits do not collide
+        self.episode_name = str(global_step) if map_dir is None else '{}_{}'.format(os.path.basename(os.path.normpath(map_dir)), global_step)
 
         # Initialise varibles
         self.travel_dist = 0
         self.robot_position = self.env.start_position  
 
+        # frames of a saved episode are encoded on a background thread
+        self.gif_encoder = None
+
+        # targets, rewards and belief checksums of a replayable episode trace
+        self.trace = None
+        if TRACE_EVERY_N_EPISODES > 0 and global_step % TRACE_EVERY_N_EPISODES == 0:
+            self.trace = TraceRecorder(self.env, self.k_size, self.max_timestep)
+
         # Episode buffer
         self.episode_buffer = []
         self.perf_metrics = dict()
+        self.reset_episode_buffer()
+
+        # Episode progress, kept between fragments
+        self.num_step = 0
+        self.reward = 0
+        self.done = False
+        self.episode_over = False
+        self.next_observations = None # observation of the decision that starts the next fragment
+
+    def reset_episode_buffer(self):
+        self.episode_buffer = []
         for i in range(5):
             self.episode_buffer.append([])
 
@@ -61,6 +87,7 @@ class Worker:
         return y_start, y_end, x_start, x_end, local_robot_y, local_robot_x
 
     # Retrieve observation with shape (8 x Local H x Local W)
+    @timed('get_observations')
     def get_observations(self):
         # observation[0, :, :] probability of obstacle
         # observation[1, :, :] probability of exploration
@@ -76,7 +103,8 @@ class Worker:
         
         global_map = torch.zeros(4, ground_truth_size[0], ground_truth_size[1]).to(self.local_device)
         local_map = torch.zeros(4, local_size[0], local_size[1]).to(self.local_device)
-        observations = torch.zeros(8, local_size[0], local_size[1]).to(self.local_device) # (8,height,width)
+        observations = torch.zeros(8, local_size[0] // OBS_DOWNSCALING, \
+                                   local_size[1] // OBS_DOWNSCALING).to(self.local_device) # (8,height,width)
 
         lmb = self.get_local_map_boundaries(self.robot_position, local_size, ground_truth_size)
 
@@ -99,8 +127,12 @@ class Worker:
         
         local_map = global_map[:, lmb[0]:lmb[1], lmb[2]:lmb[3]] # (width,height)
 
-        observations[0:4, :, :] = local_map.detach()
-        observations[4:, :, :] = nn.MaxPool2d(MAP_DOWNSIZE_FACTOR)(global_map)
+        if OBS_DOWNSCALING == 1:
+            observations[0:4, :, :] = local_map.detach()
+        else:
+            # already apply Global_Policy's first pooling layer
+            observations[0:4, :, :] = nn.MaxPool2d(OBS_DOWNSCALING)(local_map)
+        observations[4:, :, :] = nn.MaxPool2d(MAP_DOWNSIZE_FACTOR * OBS_DOWNSCALING)(global_map)
 
         '''map check uncomment to check output of observation'''
         # fig, axes = plt.subplots(1, 3, figsize=(10, 5))
@@ -111,7 +143,8 @@ class Worker:
         return observations
     
     def save_observations(self, observations):
-        self.episode_buffer[0].append(observations)
+        # binary channels are stored compactly and only expanded to float for training
+        self.episode_buffer[0].append(compress_observations(observations))
 
     def save_action(self, action, action_log_probs):
         self.episode_buffer[1].append(action)
@@ -120,11 +153,12 @@ class Worker:
     def save_reward_done(self, reward, done):        
         self.episode_buffer[3].append(torch.tensor(reward, dtype=torch.float).to(self.local_device))
 
-    def save_return(self, episode_rewards):
+    def save_return(self, episode_rewards, bootstrap_value=0):
         # The returns per episode per batch to return.
 		# The shape will be (num timesteps per episode)
+        # A fragment that stops before the episode ends bootstraps from the value of its next observation
         episode_returns = []
-        discounted_reward = 0 # The discounted reward so far
+        discounted_reward = float(bootstrap_value) # The discounted reward so far
 
         # Iterate through all rewards per episode backwards
         for rew in reversed(episode_rewards):
@@ -133,6 +167,13 @@ class Worker:
         episode_returns = torch.tensor(episode_returns, dtype=torch.float).to(self.local_device)
         self.episode_buffer[4] = episode_returns
 
+    # Episode buffer as contiguous arrays (observations, actions, log probs, rewards, returns)
+    # which Ray keeps in the object store and the driver reads without copying
+    def get_episode_arrays(self):
+        episode_arrays = [torch.stack(self.episode_buffer[i]) for i in range(4)]
+        episode_arrays.append(self.episode_buffer[4])
+        return [data.cpu().numpy() for data in episode_arrays]
+
     # Process actor output to target position
     def find_target_pos(self, action):
         with torch.no_grad():
@@ -153,12 +194,12 @@ class Worker:
                 closest_frontier = frontier
         return closest_frontier
 
-    def run_episode(self, curr_episode):
-        done = False
-
+    # Observe, act and turn the raw action into the target node to travel to
+    def select_target(self):
         observations = self.get_observations()
-        self.save_observations(observations)
-        value, action, action_log_probs = self.actor_critic.act(observations)
+        with stage('act'):
+            value, action, action_log_probs = self.actor_critic.act(observations)
+        self.action, self.action_log_probs = action, action_log_probs
 
         '''From raw action -> target pos -> waypoint
         -> waypoint node -> waypoint node pos'''
@@ -168,19 +209,40 @@ class Worker:
         # waypoint_node_position = self.env.node_coords[waypoint_node_index]
 
         '''From raw action -> target pos -> target node -> target not pos'''
-        target_position = self.find_target_pos(action)
-        target_node_index = self.env.find_index_from_coords(target_position)
-        target_node_position = self.env.node_coords[target_node_index]
-
-        reward = 0
-
-        for num_step in range(self.max_timestep):
-
-            planning_step = num_step // NUM_ACTION_STEP
-            action_step = num_step % NUM_ACTION_STEP
+        self.target_position = self.find_target_pos(action)
+        target_node_index = self.env.find_index_from_coords(self.target_position)
+        self.target_node_position = self.env.node_coords[target_node_index]
+        if self.trace is not None:
+            self.trace.target(self.target_position)
+        return observations, value
+
+    def begin_episode(self):
+        self.next_observations, _ = self.select_target()
+
+    # Advance the episode until num_planning_steps decisions are in the episode buffer or it ends
+    def run_fragment(self, num_planning_steps):
+        try:
+            self.advance(num_planning_steps)
+        except BaseException:
+            # the encoder thread is not a daemon, left waiting for frames it would keep the process alive
+            if self.gif_encoder is not None:
+                self.gif_encoder.abort()
+                self.gif_encoder = None
+            raise
+
+    def advance(self, num_planning_steps):
+        self.reset_episode_buffer()
+        self.save_observations(self.next_observations)
+
+        while self.num_step < self.max_timestep:
+
+            planning_step = self.num_step // NUM_ACTION_STEP
+            action_step = self.num_step % NUM_ACTION_STEP
+            num_step = self.num_step
+            self.num_step += 1
 
             # Use a star to find shortest path to target node
-            dist, route = self.env.graph_generator.find_shortest_path(self.robot_position, target_node_position, self.env.node_coords)
+            dist, route = self.env.graph_generator.find_shortest_path(self.robot_position, self.target_node_position, self.env.node_coords)
 
             # Handle route given
             # If target == curent pos, remain at same spot
@@ -194,62 +256,71 @@ class Worker:
             else:
                 next_position = self.env.node_coords[int(route[1])]
 
-            step_reward, done, self.robot_position, self.travel_dist = self.env.step(self.robot_position, next_position, target_position, self.travel_dist)
-            reward += step_reward
+            step_reward, self.done, self.robot_position, self.travel_dist = self.env.step(self.robot_position, next_position, self.target_position, self.travel_dist)
+            self.reward += step_reward
+            if self.trace is not None:
+                self.trace.step(step_reward, self.env.robot_belief, route)
             
             # save a frame
             if self.save_image:
-                if not os.path.exists(gifs_path):
-                    os.makedirs(gifs_path)
-                self.env.plot_env(self.global_step, gifs_path, num_step, self.travel_dist)
+                if self.gif_encoder is None:
+                    os.makedirs(gifs_path, exist_ok=True)
+                    self.gif_encoder = GifEncoder('{}/{}.gif'.format(gifs_path, self.episode_name))
+                self.gif_encoder.add(self.env.render_frame())
             
             # At last action step do global selection
-            if action_step == NUM_ACTION_STEP - 1 or done:
-                self.save_action(action, action_log_probs)
-                self.save_reward_done(reward, done)
+            if action_step == NUM_ACTION_STEP - 1 or self.done:
+                self.save_action(self.action, self.action_log_probs)
+                self.save_reward_done(self.reward, self.done)
 
-                reward = 0
+                self.reward = 0
 
-                if done or planning_step == NUM_PLANNING_STEP - 1:
+                if self.done or planning_step == NUM_PLANNING_STEP - 1:
                     self.save_return(self.episode_buffer[3]) # input rewards to cal return
-                    break
+                    self.finish_episode()
+                    return
+
+                observations, value = self.select_target()
+
+                # fragment is full, its tail is bootstrapped and this decision starts the next one
+                if len(self.episode_buffer[3]) >= num_planning_steps:
+                    self.save_return(self.episode_buffer[3], value)
+                    self.next_observations = observations
+                    return
 
-                observations = self.get_observations()
                 self.save_observations(observations)
-                value, action, action_log_probs = self.actor_critic.act(observations)
-
-                '''From raw action -> target pos -> waypoint
-                -> waypoint node -> waypoint node pos'''
-                # target_position = self.find_target_pos(action)
-                # waypoint = self.find_waypoint(target_position)
-                # waypoint_node_index = self.env.find_index_from_coords(waypoint)
-                # waypoint_node_position = self.env.node_coords[waypoint_node_index]
-                
-                '''From raw action -> target pos -> target node -> target not pos'''
-                target_position = self.find_target_pos(action)
-                target_node_index = self.env.find_index_from_coords(target_position)
-                target_node_position = self.env.node_coords[target_node_index]   
+
+        # ran out of timesteps before the last planning step
+        self.save_return(self.episode_buffer[3])
+        self.finish_episode()
+
+    def finish_episode(self):
+        self.episode_over = True
 
         # save metrics
         self.perf_metrics['travel_dist'] = self.travel_dist
         self.perf_metrics['explored_rate'] = self.env.explored_rate
-        self.perf_metrics['success_rate'] = done
+        self.perf_metrics['success_rate'] = self.done
+
+        if self.trace is not None:
+            self.trace.save('{}/traces/episode_{}.npz'.format(train_path, self.episode_name))
 
         # save gif
         if self.save_image:
             path = gifs_path
-            self.make_gif(path, curr_episode)
+            with stage('make_gif'):
+                self.make_gif(path, self.episode_name)
+
+    def run_episode(self, curr_episode):
+        self.begin_episode()
+        self.run_fragment(NUM_PLANNING_STEP)
 
     def work(self, currEpisode):
         self.run_episode(currEpisode)
 
     def make_gif(self, path, n):
-        with imageio.get_writer('{}/{}_explored_rate_{:.4g}.gif'.format(path, n, self.env.explored_rate), mode='I', duration=0.5) as writer:
-            for frame in self.env.frame_files:
-                image = imageio.imread(frame)
-                writer.append_data(image)
-        print('gif complete\n')
-
-        # Remove files
-        for filename in self.env.frame_files[:-1]:
-            os.remove(filename)
\ No newline at end of file
+        # the encoder finishes the gif and writes the final frame as a png in the background
+        if self.gif_encoder is not None:
+            self.gif_encoder.close('{}/{}_explored_rate_{:.4g}.gif'.format(path, n, self.env.explored_rate),
+                                   '{}/{}_{}_samples.png'.format(path, n, self.num_step - 1))
+            self.gif_encoder = None
\ No newline at end of file